@@ -0,0 +1,88 @@
+"""Rolling accumulation of recent lidar scans into a fixed size point buffer."""
+
+from __future__ import annotations
+
+import asyncio
+
+import numpy as np
+
+WINDOW_SECONDS = 10.0
+MAX_POINTS = 2_000_000
+
+
+class ScanAccumulator:
+    """Keeps the points of the scans of the last window_seconds in a ring buffer.
+
+    The buffer is preallocated for max_points, so memory use is fixed no matter how
+    long a sweep runs: when it is full the oldest points are overwritten. Points are
+    numbered by a running counter, which readers use as a cursor to fetch only the
+    points added since their last read.
+    """
+
+    def __init__(
+        self, window_seconds: float = WINDOW_SECONDS, max_points: int = MAX_POINTS
+    ) -> None:
+        self.window_seconds = window_seconds
+        self.max_points = max_points
+        self._xyz = np.zeros((3, max_points), dtype=np.float32)
+        self._timestamp_ns = np.zeros(max_points, dtype=np.int64)
+        self._written = 0
+        self._newest_ns = 0
+        self._updated = asyncio.Event()
+        self.closed = False
+
+    @property
+    def cursor(self) -> int:
+        """The number of points added so far."""
+        return self._written
+
+    @property
+    def newest_ns(self) -> int:
+        """The timestamp of the newest scan, in nanoseconds since the epoch."""
+        return self._newest_ns
+
+    def add(self, x: np.ndarray, y: np.ndarray, z: np.ndarray, timestamp_ns: int):
+        """Add the points of a scan."""
+        num_points = min(len(x), self.max_points)
+        start = self._written % self.max_points
+        first = min(num_points, self.max_points - start)
+        for axis, values in enumerate((x, y, z)):
+            values = values[len(values) - num_points :]
+            self._xyz[axis, start : start + first] = values[:first]
+            self._xyz[axis, : num_points - first] = values[first:]
+        self._timestamp_ns[start : start + first] = timestamp_ns
+        self._timestamp_ns[: num_points - first] = timestamp_ns
+
+        self._written += num_points
+        self._newest_ns = max(self._newest_ns, timestamp_ns)
+
+        # wake up the readers waiting for new points
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def _read(self, cursor: int):
+        cursor = max(cursor, self._written - self.max_points)
+        positions = np.arange(cursor, self._written) % self.max_points
+        oldest_ns = self._newest_ns - int(self.window_seconds * 1e9)
+        positions = positions[self._timestamp_ns[positions] >= oldest_ns]
+        x, y, z = self._xyz[:, positions]
+        return x, y, z
+
+    def snapshot(self):
+        """Return the x, y and z arrays of all the points within the window."""
+        return self._read(0)
+
+    def since(self, cursor: int):
+        """Return the points within the window added after cursor, and the new cursor."""
+        x, y, z = self._read(cursor)
+        return x, y, z, self._written
+
+    async def wait(self, cursor: int) -> None:
+        """Wait until points were added after cursor, or the accumulator is closed."""
+        while self._written == cursor and not self.closed:
+            await self._updated.wait()
+
+    def close(self) -> None:
+        """Stop accumulating and wake up the waiting readers."""
+        self.closed = True
+        self._updated.set()
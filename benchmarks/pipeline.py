@@ -0,0 +1,418 @@
+"""Benchmark the lidar decode and streaming hot paths on synthetic scans.
+
+Usage:
+    python benchmarks/pipeline.py --output before.json
+    python benchmarks/pipeline.py --output after.json --compare before.json
+
+The scans are lidar_pb2.SickScanPointCloudMsg of --points points (an LMS4000
+scan by default) with float32 x, y, z, i, range, azimuth and elevation fields.
+Each function is timed with timeit, reporting the median seconds per scan over
+--repeat rounds. The websocket benchmark runs main.py's app in a uvicorn
+subprocess, fed by a synthetic lidar instead of the lidar service, and counts
+the frames a client receives in --seconds.
+
+The scan codecs (see scan_codec.py) are benchmarked on --scans scans, taken
+from --recording to report their compression ratio and MB/s on real data.
+
+Benchmarks whose dependencies are missing (sick_scan_api for to_proto and
+from_proto, uvicorn and websockets for the websocket, zstandard and lz4 for the
+codecs) report an error instead.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from datetime import datetime
+
+import numpy as np
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIRECTORY)
+
+import lidar_pb2  # noqa: E402
+from frames import DeltaFrameEncoder, encode_points_frame  # noqa: E402
+from pointcloud import pySickScanCartesianPointCloudMsgToXYZ  # noqa: E402
+from scan_codec import SCAN_CODECS, decode_buffer, encode_buffer  # noqa: E402
+from sweep_reader import SweepReader  # noqa: E402
+from topic_encoders import dumps_json, encode_message  # noqa: E402
+
+# 70 degrees at 0.0833 degree resolution
+SCAN_POINTS = 841
+SCAN_FIELDS = ("x", "y", "z", "i", "range", "azimuth", "elevation")
+FLOAT32 = 7  # SICK_SCAN_POINTFIELD_DATATYPE_FLOAT32
+
+
+def synthetic_scan(num_points=SCAN_POINTS, seq=0, seed=0):
+    """A single layer scan of a wall about 2 m away, as a SickScanPointCloudMsg."""
+    rng = np.random.default_rng(seed)
+    azimuth = np.linspace(-np.radians(35), np.radians(35), num_points)
+    ranges = 2.0 / np.cos(azimuth) + rng.normal(0.0, 0.005, num_points)
+
+    points = np.zeros(num_points, dtype=[(name, "<f4") for name in SCAN_FIELDS])
+    points["x"] = ranges * np.cos(azimuth)
+    points["y"] = ranges * np.sin(azimuth)
+    points["i"] = rng.uniform(0, 255, num_points)
+    points["range"] = ranges
+    points["azimuth"] = azimuth
+
+    scan = lidar_pb2.SickScanPointCloudMsg()
+    scan.header.seq = seq
+    scan.header.timestamp_sec = int(time.time())
+    scan.header.frame_id = b"cloud"
+    scan.height = 1
+    scan.width = num_points
+    scan.point_step = points.dtype.itemsize
+    scan.row_step = points.dtype.itemsize * num_points
+    scan.is_dense = 1
+    scan.data.buffer = points.tobytes()
+    scan.data.size = scan.data.capacity = len(scan.data.buffer)
+    for name in SCAN_FIELDS:
+        field = scan.fields.buffer.add()
+        field.name = name.encode()
+        field.offset = points.dtype.fields[name][1]
+        field.datatype = FLOAT32
+        field.count = 1
+    scan.fields.size = scan.fields.capacity = len(SCAN_FIELDS)
+    return scan
+
+
+def recorded_scans(directory, num_scans):
+    """The first num_scans scans of a recorded sweep."""
+    with SweepReader(directory) as reader:
+        return list(itertools.islice(reader.scans(), num_scans))
+
+
+def timed(name, function, repeat, scans=1, **extra):
+    """Time function() with timeit, as the median seconds per scan.
+
+    Args:
+        scans: the number of scans function handles per call.
+    """
+    try:
+        timer = timeit.Timer(function)
+        number, _ = timer.autorange()
+        rounds = timer.repeat(repeat, number)
+    except Exception as error:
+        return {"name": name, "error": f"{type(error).__name__}: {error}"}
+
+    seconds = statistics.median(rounds) / number / scans
+    return {"name": name, "seconds": seconds, "scans_per_second": 1 / seconds, **extra}
+
+
+def decode_benchmarks(scan, repeat):
+    data = scan.SerializeToString()
+    start_time = datetime.now()
+    results = [
+        timed("serialize_protobuf", scan.SerializeToString, repeat, bytes=len(data)),
+        timed(
+            "parse_protobuf",
+            lambda: lidar_pb2.SickScanPointCloudMsg.FromString(data),
+            repeat,
+        ),
+        timed(
+            "pySickScanCartesianPointCloudMsgToXYZ",
+            lambda: pySickScanCartesianPointCloudMsgToXYZ(scan, start_time),
+            repeat,
+        ),
+    ]
+
+    try:
+        from utils import from_proto, to_proto
+
+        message = from_proto(scan)
+    except ImportError as error:
+        # the ctypes messages need the sick_scan_api module of the driver
+        for name in ("to_proto", "from_proto"):
+            results.append({"name": name, "error": str(error)})
+    else:
+        results.append(timed("to_proto", lambda: to_proto(message), repeat))
+        results.append(timed("from_proto", lambda: from_proto(scan), repeat))
+    return results
+
+
+def encode_benchmarks(scan, repeat):
+    x, y, z = pySickScanCartesianPointCloudMsgToXYZ(scan, datetime.now())
+    fields = {"x": x, "y": y, "z": z}
+    # the scan against itself as the keyframe, i.e. the delta frames in between
+    delta_encoder = DeltaFrameEncoder(keyframe_interval=2**31)
+    delta_encoder.encode(scan.header, fields)
+    return [
+        timed(
+            "encode_json",
+            lambda: dumps_json(fields),
+            repeat,
+            bytes=len(dumps_json(fields).encode()),
+        ),
+        timed(
+            "encode_binary",
+            lambda: encode_points_frame(scan.header, fields),
+            repeat,
+            bytes=len(encode_points_frame(scan.header, fields)),
+        ),
+        timed(
+            "encode_delta",
+            lambda: delta_encoder.encode(scan.header, fields),
+            repeat,
+            bytes=len(delta_encoder.encode(scan.header, fields)),
+        ),
+        timed(
+            "encode_message_json",
+            lambda: encode_message(scan, "json"),
+            repeat,
+            bytes=len(encode_message(scan, "json").encode()),
+        ),
+    ]
+
+
+def codec_benchmarks(scans, repeat):
+    if not SCAN_CODECS:
+        return [{"name": "codec", "error": "neither zstandard nor lz4 is installed"}]
+
+    raw_bytes = sum(len(scan.data.buffer) for scan in scans)
+    results = []
+    for codec in SCAN_CODECS:
+        encoded = [encode_buffer(scan, codec) for scan in scans]
+        # decode_buffer only reads the layout and data.buffer of the scan
+        encoded_scans = []
+        for scan, buffer in zip(scans, encoded):
+            encoded_scan = lidar_pb2.SickScanPointCloudMsg()
+            encoded_scan.CopyFrom(scan)
+            encoded_scan.data.buffer = buffer
+            encoded_scans.append(encoded_scan)
+
+        encode = timed(
+            f"encode_{codec}",
+            lambda: [encode_buffer(scan, codec) for scan in scans],
+            repeat,
+            scans=len(scans),
+        )
+        decode = timed(
+            f"decode_{codec}",
+            lambda: [decode_buffer(scan) for scan in encoded_scans],
+            repeat,
+            scans=len(scans),
+        )
+        ratio = raw_bytes / sum(len(buffer) for buffer in encoded)
+        for result in (encode, decode):
+            result["ratio"] = ratio
+            if "seconds" in result:
+                result["megabytes_per_second"] = (
+                    raw_bytes / len(scans) / result["seconds"] / 1e6
+                )
+            results.append(result)
+    return results
+
+
+class SyntheticLidarClient:
+    """Stands in for the EventClient of the lidar service, for main.py's app.
+
+    Publishes the same scan, with increasing seqs, at rate Hz (as fast as the
+    subscribers take them when rate is 0).
+    """
+
+    def __init__(self, scan, rate=0.0):
+        self.scan = scan
+        self.period = 1.0 / rate if rate > 0 else 0.0
+
+    async def request_reply(self, path, message):
+        return None
+
+    async def subscribe(self, request, decode=True):
+        for seq in itertools.count():
+            self.scan.header.seq = seq & 0xFFFFFFFF
+            yield None, self.scan
+            await asyncio.sleep(self.period)
+
+
+def serve(port, num_points, rate):
+    """Run main.py's app with a synthetic lidar, until the process is killed."""
+    import uvicorn
+
+    import main
+
+    main.clients["lidar"] = SyntheticLidarClient(synthetic_scan(num_points), rate)
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def _wait_for_port(port, process, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+async def _receive_frames(url, seconds):
+    import websockets
+
+    async with websockets.connect(url, max_size=None) as websocket:
+        # the first frame arrives once the upstream subscription is running
+        await websocket.recv()
+        frames = received = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            frame = await websocket.recv()
+            frames += 1
+            received += len(frame)
+        elapsed = time.perf_counter() - start
+
+    return {
+        "frames_per_second": frames / elapsed,
+        "megabytes_per_second": received / elapsed / 1e6,
+        "bytes": received / max(frames, 1),
+    }
+
+
+def websocket_benchmarks(num_points, seconds, port, rate=0.0):
+    formats = ("json", "binary")
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--serve",
+            "--port",
+            str(port),
+            "--points",
+            str(num_points),
+            "--rate",
+            str(rate),
+        ],
+        cwd=REPO_DIRECTORY,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        if not _wait_for_port(port, process):
+            process.kill()
+            error = process.communicate()[1].strip().splitlines()
+            error = error[-1] if error else "the server did not start"
+            return [
+                {"name": f"websocket_{format}", "error": error} for format in formats
+            ]
+
+        results = []
+        for format in formats:
+            url = f"ws://127.0.0.1:{port}/subscribe/lidar/data?format={format}"
+            try:
+                throughput = asyncio.run(_receive_frames(url, seconds))
+            except Exception as error:
+                results.append(
+                    {
+                        "name": f"websocket_{format}",
+                        "error": f"{type(error).__name__}: {error}",
+                    }
+                )
+                continue
+            results.append({"name": f"websocket_{format}", **throughput})
+        return results
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def _git_commit():
+    result = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=REPO_DIRECTORY,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip() or None
+
+
+def compare(results, baseline):
+    """Print the change of each benchmark from the baseline results."""
+    previous = {result["name"]: result for result in baseline["results"]}
+    print(f"compared to {baseline.get('commit')}:", file=sys.stderr)
+    for result in results["results"]:
+        old = previous.get(result["name"], {})
+        for metric in ("scans_per_second", "frames_per_second"):
+            if metric in result and metric in old:
+                change = result[metric] / old[metric] - 1
+                print(
+                    f"  {result['name']:40} {old[metric]:12.1f} ->"
+                    f" {result[metric]:12.1f} {metric} ({change:+.1%})",
+                    file=sys.stderr,
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--points", type=int, default=SCAN_POINTS, help="points per scan"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="timeit rounds")
+    parser.add_argument(
+        "--seconds", type=float, default=5.0, help="length of each websocket run"
+    )
+    parser.add_argument("--port", type=int, default=8099, help="the app's port")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0.0,
+        help="the synthetic lidar's scan rate (Hz), 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--no-websocket", action="store_true", help="skip the websocket benchmark"
+    )
+    parser.add_argument(
+        "--recording",
+        help="a recorded sweep to take the scans from, instead of synthetic scans",
+    )
+    parser.add_argument(
+        "--scans", type=int, default=100, help="scans for the codec benchmark"
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="a previous --output to compare to")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, args.points, args.rate)
+        sys.exit()
+
+    if args.recording:
+        scans = recorded_scans(args.recording, args.scans)
+    else:
+        scans = [
+            synthetic_scan(args.points, seq, seed=seq) for seq in range(args.scans)
+        ]
+    scan = scans[0]
+    results = {
+        "commit": _git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "data": args.recording or "synthetic",
+        "points": scan.width * scan.height,
+        "results": decode_benchmarks(scan, args.repeat)
+        + encode_benchmarks(scan, args.repeat)
+        + codec_benchmarks(scans, args.repeat),
+    }
+    if not args.no_websocket:
+        results["results"] += websocket_benchmarks(
+            args.points, args.seconds, args.port, args.rate
+        )
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
@@ -0,0 +1,85 @@
+"""Measure the import time and resident memory of app modules in a fresh interpreter.
+
+Usage:
+    python benchmarks/startup.py main pointcloud utils
+    python benchmarks/startup.py main --before HEAD~1
+
+With --before the modules are also imported from that revision (checked out in a
+temporary git worktree), to compare e.g. before and after a change to the imports
+of main.py. Each module is imported in its own subprocess, --repeat times.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs in the subprocess: import the module, report seconds and peak RSS
+MEASURE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+loaded = "sick_scan_api" in sys.modules
+print(json.dumps({{"seconds": elapsed, "max_rss_mb": peak_kb / 1024, "sick_scan_api": loaded}}))
+"""
+
+
+def measure(module, repeat, directory=REPO_DIRECTORY):
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", MEASURE.format(module=module)],
+            cwd=directory,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()
+            return {"module": module, "error": error[-1] if error else "failed"}
+        runs.append(json.loads(result.stdout))
+
+    return {
+        "module": module,
+        "seconds": statistics.median(run["seconds"] for run in runs),
+        "max_rss_mb": statistics.median(run["max_rss_mb"] for run in runs),
+        "sick_scan_api_loaded": runs[0]["sick_scan_api"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="+", help="the modules to import")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per module")
+    parser.add_argument("--before", help="a git revision to compare against")
+    args = parser.parse_args()
+
+    results = [measure(module, args.repeat) for module in args.modules]
+    if args.before:
+        with tempfile.TemporaryDirectory() as directory:
+            worktree = os.path.join(directory, "before")
+            subprocess.run(
+                ["git", "worktree", "add", "--detach", worktree, args.before],
+                cwd=REPO_DIRECTORY,
+                check=True,
+                capture_output=True,
+            )
+            try:
+                before = [
+                    measure(module, args.repeat, worktree) for module in args.modules
+                ]
+            finally:
+                subprocess.run(
+                    ["git", "worktree", "remove", "--force", worktree],
+                    cwd=REPO_DIRECTORY,
+                    check=True,
+                )
+        results = {"before": before, "after": results}
+
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,177 @@
+"""Fan out one upstream event service subscription to many websocket viewers."""
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+from enum import Enum
+from typing import AsyncIterator, Callable, Hashable
+
+logger = logging.getLogger("uvicorn")
+
+
+class OverflowPolicy(str, Enum):
+    """What a SendQueue does with a new frame when it is full."""
+
+    DROP_OLDEST = "drop_oldest"  # discard the oldest queued frame
+    LATEST = "latest"  # only ever keep the most recent frame
+    BLOCK = "block"  # wait for the viewer, stalling the upstream subscription
+
+
+class SendQueue:
+    """A bounded queue of frames waiting to be sent to one websocket."""
+
+    def __init__(
+        self, maxsize: int = 4, policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST
+    ) -> None:
+        self.policy = OverflowPolicy(policy)
+        self.maxsize = 1 if self.policy is OverflowPolicy.LATEST else max(1, maxsize)
+        self.closed = False
+        self.frames_queued = 0
+        self.frames_dropped = 0
+        self._frames: collections.deque = collections.deque()
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def qsize(self) -> int:
+        return len(self._frames)
+
+    async def put(self, frame) -> None:
+        """Queue a frame, applying the overflow policy when the queue is full."""
+        if self.closed:
+            return
+        if self.policy is OverflowPolicy.BLOCK:
+            while len(self._frames) >= self.maxsize and not self.closed:
+                self._writable.clear()
+                await self._writable.wait()
+            if self.closed:
+                return
+        elif len(self._frames) >= self.maxsize:
+            self._frames.popleft()
+            self.frames_dropped += 1
+
+        self._frames.append(frame)
+        self.frames_queued += 1
+        self._readable.set()
+
+    async def get(self):
+        """Return the next frame, or None once the queue is closed and drained."""
+        while not self._frames:
+            if self.closed:
+                return None
+            self._readable.clear()
+            await self._readable.wait()
+        frame = self._frames.popleft()
+        self._writable.set()
+        return frame
+
+    def close(self) -> None:
+        """Stop accepting frames and wake up any waiting put or get."""
+        self.closed = True
+        self._readable.set()
+        self._writable.set()
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy.value,
+            "maxsize": self.maxsize,
+            "queued": self.qsize(),
+            "frames_queued": self.frames_queued,
+            "frames_dropped": self.frames_dropped,
+        }
+
+
+class Broadcaster:
+    """Holds a single upstream subscription and shares each encoded frame.
+
+    Every message is encoded once and put on the SendQueue of each attached viewer.
+    The upstream subscription starts with the first viewer and is cancelled when
+    the last one detaches. When the upstream ends, the viewer queues are closed.
+    """
+
+    def __init__(
+        self,
+        key: Hashable,
+        subscribe: Callable[[], AsyncIterator],
+        encode: Callable,
+        on_close: Callable[[Broadcaster], None],
+        on_attach: Callable[[Broadcaster], None] | None = None,
+    ) -> None:
+        """Initialize the broadcaster.
+
+        Args:
+            key: the key identifying this broadcaster, e.g. (service, uri, every_n).
+            subscribe: returns an async iterator over the upstream messages.
+            encode: converts a message into a frame (str or bytes) for the websockets.
+            on_close: called once the upstream task has finished.
+            on_attach: called whenever a viewer attaches, including the first.
+        """
+        self.key = key
+        self._subscribe = subscribe
+        self._encode = encode
+        self._on_close = on_close
+        self._on_attach = on_attach
+        self._queues: list[SendQueue] = []
+        self.messages_received = 0
+        self._task: asyncio.Task | None = None
+        self._closed = False
+
+    @property
+    def num_viewers(self) -> int:
+        return len(self._queues)
+
+    def attach(
+        self,
+        queue_size: int = 4,
+        policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+    ) -> SendQueue:
+        """Attach a viewer and start the upstream subscription if needed."""
+        queue = SendQueue(queue_size, policy)
+        self._queues.append(queue)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if self._on_attach is not None:
+            self._on_attach(self)
+        return queue
+
+    def detach(self, queue: SendQueue) -> None:
+        """Detach a viewer, shutting down the upstream when it was the last one."""
+        queue.close()
+        if queue in self._queues:
+            self._queues.remove(queue)
+        if not self._queues and self._task is not None:
+            self._close()
+            self._task.cancel()
+
+    def _close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._on_close(self)
+
+    def stats(self) -> dict:
+        return {
+            "messages_received": self.messages_received,
+            "viewers": [queue.stats() for queue in self._queues],
+        }
+
+    async def _run(self) -> None:
+        messages = self._subscribe()
+        try:
+            async for message in messages:
+                self.messages_received += 1
+                if not self._queues:
+                    continue
+                frame = self._encode(message)
+                for queue in list(self._queues):
+                    await queue.put(frame)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("Upstream subscription %s failed", self.key)
+        finally:
+            await messages.aclose()
+            for queue in self._queues:
+                queue.close()
+            self._close()
@@ -0,0 +1,177 @@
+"""Stream recorded sweeps as columnar Parquet or Arrow tables, one row per point.
+
+The columns are scan_seq and timestamp_ns (of the scan of the point), then one
+per field of the scans: x, y, z, intensity (the "i" field), range, azimuth, ...
+with their type in the scans. Fields with several values per point are split
+into name_0, name_1, ...
+
+Every CHUNK_SCANS scans are written as one Parquet row group (or Arrow record
+batch) and handed out as soon as they are encoded, so a sweep is read once and
+only one chunk is in memory. The row groups are in recording order and carry
+min/max statistics, so readers can skip them by scan_seq or timestamp_ns:
+
+    pandas.read_parquet("sweep.parquet", filters=[("timestamp_ns", ">=", start)])
+    polars.scan_parquet("sweep.parquet").filter(pl.col("scan_seq") < 1000)
+
+Needs pyarrow.
+
+Usage:
+    python columnar.py /path/to/lidar_<date> sweep.parquet
+    python columnar.py /path/to/lidar_<date> sweep.arrow
+"""
+
+from __future__ import annotations
+
+import argparse
+from typing import Iterator
+
+import numpy as np
+
+from pointcloud import pointcloud_msg_to_points
+from scan_log import scan_timestamp_ns
+from sweep_reader import SweepReader
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+COLUMNAR_FORMATS = ("parquet", "arrow") if pa is not None else ()
+CHUNK_SCANS = 256
+PARQUET_COMPRESSION = "zstd"
+# columns named differently from the fields of the scans
+COLUMN_NAMES = {"i": "intensity"}
+
+
+class _ChunkSink:
+    """A write-only file collecting the bytes written since the last drain()."""
+
+    def __init__(self) -> None:
+        self.closed = False
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        chunks, self._chunks = self._chunks, []
+        return b"".join(chunks)
+
+
+def _point_columns(points: np.ndarray) -> dict[str, np.ndarray]:
+    columns = {}
+    for name in points.dtype.names:
+        values = points[name]
+        # Arrow only takes native byte order
+        values = values.astype(values.dtype.newbyteorder("="), copy=False)
+        column = COLUMN_NAMES.get(name, name)
+        if values.ndim > 1:
+            for k in range(values.shape[1]):
+                columns[f"{column}_{k}"] = values[:, k]
+        else:
+            columns[column] = values
+    return columns
+
+
+def _table(chunk: list[tuple[int, int, np.ndarray]]) -> pa.Table:
+    seqs, timestamps, points = zip(*chunk)
+    counts = [len(scan_points) for scan_points in points]
+    columns = {
+        "scan_seq": np.repeat(np.array(seqs, dtype=np.uint32), counts),
+        "timestamp_ns": np.repeat(np.array(timestamps, dtype=np.int64), counts),
+    }
+    # concatenating fails for scans with different fields
+    columns.update(_point_columns(np.concatenate(points)))
+    return pa.table(columns)
+
+
+def scan_tables(
+    reader: SweepReader, chunk_scans: int = CHUNK_SCANS, **scan_range
+) -> Iterator[pa.Table]:
+    """Yield the points of chunk_scans scans at a time as a table."""
+    chunk = []
+    for scan in reader.scans(**scan_range):
+        chunk.append(
+            (
+                scan.header.seq,
+                scan_timestamp_ns(scan.header),
+                pointcloud_msg_to_points(scan),
+            )
+        )
+        if len(chunk) == chunk_scans:
+            yield _table(chunk)
+            chunk = []
+    if chunk:
+        yield _table(chunk)
+
+
+def export_columnar(
+    reader: SweepReader,
+    format: str = "parquet",
+    chunk_scans: int = CHUNK_SCANS,
+    **scan_range,
+) -> Iterator[bytes]:
+    """Yield the encoded file, one row group (or record batch) at a time.
+
+    Args:
+        reader: the sweep to export.
+        format: "parquet" or "arrow" (the Arrow IPC stream format).
+        chunk_scans: the number of scans per row group.
+        scan_range: start_time, end_time, start_seq and end_seq as for
+            SweepReader.scans.
+    """
+    assert format in COLUMNAR_FORMATS, f"unknown or unavailable format {format}"
+    sink = _ChunkSink()
+    writer = None
+    for table in scan_tables(reader, chunk_scans, **scan_range):
+        if writer is None:
+            if format == "parquet":
+                writer = pq.ParquetWriter(
+                    sink, table.schema, compression=PARQUET_COMPRESSION
+                )
+            else:
+                writer = pa.ipc.new_stream(sink, table.schema)
+        if format == "parquet":
+            writer.write_table(table, row_group_size=len(table))
+        else:
+            writer.write_table(table)
+        yield sink.drain()
+
+    if writer is None:
+        # no scans, an empty table with the scan columns only
+        schema = pa.schema([("scan_seq", pa.uint32()), ("timestamp_ns", pa.int64())])
+        if format == "parquet":
+            writer = pq.ParquetWriter(sink, schema, compression=PARQUET_COMPRESSION)
+        else:
+            writer = pa.ipc.new_stream(sink, schema)
+    writer.close()
+    yield sink.drain()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("sweep", help="the recorded sweep directory")
+    parser.add_argument("output", help="the .parquet or .arrow file to write")
+    parser.add_argument(
+        "--chunk-scans", type=int, default=CHUNK_SCANS, help="scans per row group"
+    )
+    args = parser.parse_args()
+
+    output_format = args.output.rsplit(".", 1)[-1].lower()
+    with SweepReader(args.sweep) as reader, open(args.output, "wb") as output:
+        for data in export_columnar(reader, output_format, args.chunk_scans):
+            output.write(data)
+    print(args.output, flush=True)
@@ -0,0 +1,88 @@
+"""Vectorized point reduction for lightweight live previews of the lidar scans."""
+
+from __future__ import annotations
+
+from typing import NamedTuple
+
+import numpy as np
+
+# largest number of voxels for which voxel keys are packed into a single int64
+MAX_PACKED_VOXELS = 2**62
+
+
+class PointReduction(NamedTuple):
+    """How to reduce the points of a scan before they are sent to the viewers.
+
+    Attributes:
+        stride: keep every stride-th point.
+        min_range: drop points closer than this to the lidar (m).
+        max_range: drop points further than this from the lidar (m), 0 for no limit.
+        voxel_size: average the points within each voxel of this size (m), 0 to
+            disable voxel-grid downsampling.
+    """
+
+    stride: int = 1
+    min_range: float = 0.0
+    max_range: float = 0.0
+    voxel_size: float = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self != PointReduction()
+
+    def apply(self, x: np.ndarray, y: np.ndarray, z: np.ndarray, planar: bool = False):
+        """Return the reduced x, y and z arrays.
+
+        With planar, the voxels only divide x and y, e.g. when z is a time.
+        """
+        if self.stride > 1:
+            x, y, z = x[:: self.stride], y[:: self.stride], z[:: self.stride]
+        if self.min_range > 0 or self.max_range > 0:
+            x, y, z = crop_range(x, y, z, self.min_range, self.max_range)
+        if self.voxel_size > 0:
+            x, y, z = voxel_downsample(x, y, z, self.voxel_size, planar)
+        return x, y, z
+
+
+def crop_range(x, y, z, min_range: float = 0.0, max_range: float = 0.0):
+    """Keep the points whose range in the scan plane (x, y) is within the limits."""
+    range_squared = x.astype(np.float32) ** 2 + y.astype(np.float32) ** 2
+    keep = range_squared >= min_range**2
+    if max_range > 0:
+        keep &= range_squared <= max_range**2
+    return x[keep], y[keep], z[keep]
+
+
+def _voxel_ids(keys: np.ndarray) -> np.ndarray:
+    # number the voxels 0..n-1, packing the integer keys into one int64 when possible
+    keys = keys - keys.min(axis=0)
+    dims = keys.max(axis=0) + 1
+    if np.prod(dims.astype(np.float64)) < MAX_PACKED_VOXELS:
+        packed = np.ravel_multi_index(keys.T, dims)
+        _, ids = np.unique(packed, return_inverse=True)
+    else:
+        _, ids = np.unique(keys, axis=0, return_inverse=True)
+    return ids.reshape(-1)
+
+
+def voxel_downsample(x, y, z, voxel_size: float, planar: bool = False):
+    """Replace the points in each voxel of a regular grid by their centroid.
+
+    With planar, the grid only divides x and y, and z is averaged per cell.
+    Points with a NaN or infinite coordinate are dropped.
+    """
+    xyz = np.column_stack((x, y, z)).astype(np.float64)
+    finite = np.isfinite(xyz).all(axis=1)
+    if not finite.all():
+        x, y, z, xyz = x[finite], y[finite], z[finite], xyz[finite]
+    if len(x) == 0:
+        return x, y, z
+    axes = 2 if planar else 3
+    ids = _voxel_ids(np.floor(xyz[:, :axes] / voxel_size).astype(np.int64))
+
+    counts = np.bincount(ids)
+    centroids = [
+        (np.bincount(ids, weights=xyz[:, axis]) / counts).astype(np.float32)
+        for axis in range(3)
+    ]
+    return centroids[0], centroids[1], centroids[2]
@@ -0,0 +1,237 @@
+"""Stream recorded sweeps as PLY or LAS point clouds, chunk by chunk.
+
+Both formats store the number of points (and LAS the bounds) in the file header,
+so a sweep is read twice: once to count the points, then again to encode them.
+Only one chunk of scans is in memory at a time, so exports of any size need
+neither Open3D nor the whole point cloud in memory.
+
+Usage:
+    python export.py /path/to/lidar_<date> sweep.ply
+    python export.py /path/to/lidar_<date> sweep.las --z time
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import struct
+from typing import Iterator, NamedTuple
+
+import numpy as np
+
+from pointcloud import pointcloud_msg_to_points
+from scan_log import scan_timestamp_ns
+from sweep_reader import SweepReader
+
+EXPORT_FORMATS = ("ply", "las")
+# what to use as z: the scan index / 100 as in reconstruct_lidar.py, the seconds
+# since the first scan, or the z measured by the lidar
+Z_AXES = ("index", "time", "sensor")
+CHUNK_SCANS = 256
+
+# LAS 1.2 public header block and point data record format 0
+LAS_HEADER = struct.Struct("<4sHHIHH8sBB32s32sHHHIIBHI5I3d3d6d")
+LAS_POINT_DTYPE = np.dtype(
+    [
+        ("X", "<i4"),
+        ("Y", "<i4"),
+        ("Z", "<i4"),
+        ("intensity", "<u2"),
+        ("return_flags", "u1"),
+        ("classification", "u1"),
+        ("scan_angle", "i1"),
+        ("user_data", "u1"),
+        ("point_source_id", "<u2"),
+    ]
+)
+LAS_SCALE = 0.001
+
+
+class SweepSummary(NamedTuple):
+    """The number of points and the bounds of a sweep, as needed by the headers."""
+
+    num_points: int
+    has_intensity: bool
+    mins: np.ndarray
+    maxs: np.ndarray
+
+
+def _scan_xyzi(scan, index: int, first_ns: int, z_axis: str):
+    points = pointcloud_msg_to_points(scan)
+    x = points["x"].astype(np.float64)
+    y = points["y"].astype(np.float64)
+    if z_axis == "index":
+        z = np.full(len(points), index / 100)
+    elif z_axis == "time":
+        z = np.full(len(points), (scan_timestamp_ns(scan.header) - first_ns) / 1e9)
+    else:
+        z = points["z"].astype(np.float64)
+    intensity = points["i"] if "i" in points.dtype.names else None
+    return x, y, z, intensity
+
+
+def _xyzi_chunks(
+    reader: SweepReader, z_axis: str, chunk_scans: int = CHUNK_SCANS, **scan_range
+) -> Iterator[tuple]:
+    # concatenated x, y, z and intensity of chunk_scans scans at a time
+    first_ns = None
+    chunk = []
+    for index, scan in enumerate(reader.scans(**scan_range)):
+        if first_ns is None:
+            first_ns = scan_timestamp_ns(scan.header)
+        chunk.append(_scan_xyzi(scan, index, first_ns, z_axis))
+        if len(chunk) == chunk_scans:
+            yield _concatenate(chunk)
+            chunk = []
+    if chunk:
+        yield _concatenate(chunk)
+
+
+def _concatenate(chunk):
+    x, y, z, intensity = zip(*chunk)
+    if any(values is None for values in intensity):
+        intensity = None
+    else:
+        intensity = np.concatenate(intensity).astype(np.float32)
+    return np.concatenate(x), np.concatenate(y), np.concatenate(z), intensity
+
+
+def summarize(reader: SweepReader, z_axis: str = "index", **scan_range) -> SweepSummary:
+    """Count the points of a sweep and compute their bounds."""
+    num_points = 0
+    has_intensity = True
+    mins = np.full(3, np.inf)
+    maxs = np.full(3, -np.inf)
+    for x, y, z, intensity in _xyzi_chunks(reader, z_axis, **scan_range):
+        if len(x) == 0:
+            continue
+        num_points += len(x)
+        has_intensity &= intensity is not None
+        mins = np.minimum(mins, [x.min(), y.min(), z.min()])
+        maxs = np.maximum(maxs, [x.max(), y.max(), z.max()])
+    if num_points == 0:
+        mins = maxs = np.zeros(3)
+    return SweepSummary(num_points, has_intensity, mins, maxs)
+
+
+def ply_header(summary: SweepSummary) -> bytes:
+    properties = ["x", "y", "z"] + (["intensity"] if summary.has_intensity else [])
+    lines = [
+        "ply",
+        "format binary_little_endian 1.0",
+        "comment exported by amiga-fastapi",
+        f"element vertex {summary.num_points}",
+        *(f"property float {name}" for name in properties),
+        "end_header",
+    ]
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+def las_header(summary: SweepSummary) -> bytes:
+    today = datetime.date.today()
+    mins, maxs = summary.mins, summary.maxs
+    return LAS_HEADER.pack(
+        b"LASF",
+        0,  # file source id
+        0,  # global encoding
+        0,  # project id
+        0,
+        0,
+        b"",
+        1,  # version 1.2
+        2,
+        b"amiga-fastapi",
+        b"amiga-fastapi export.py",
+        today.timetuple().tm_yday,
+        today.year,
+        LAS_HEADER.size,
+        LAS_HEADER.size,  # offset to the point data, there are no VLRs
+        0,
+        0,  # point data format 0
+        LAS_POINT_DTYPE.itemsize,
+        summary.num_points,
+        summary.num_points,  # all points are single returns
+        0,
+        0,
+        0,
+        0,
+        LAS_SCALE,
+        LAS_SCALE,
+        LAS_SCALE,
+        *mins,  # offsets
+        maxs[0],
+        mins[0],
+        maxs[1],
+        mins[1],
+        maxs[2],
+        mins[2],
+    )
+
+
+def _encode_ply(x, y, z, intensity) -> bytes:
+    names = ["x", "y", "z"] + (["intensity"] if intensity is not None else [])
+    records = np.empty(len(x), dtype=[(name, "<f4") for name in names])
+    records["x"], records["y"], records["z"] = x, y, z
+    if intensity is not None:
+        records["intensity"] = intensity
+    return records.tobytes()
+
+
+def _encode_las(x, y, z, intensity, offsets) -> bytes:
+    records = np.zeros(len(x), dtype=LAS_POINT_DTYPE)
+    for field, values, offset in zip("XYZ", (x, y, z), offsets):
+        records[field] = np.round((values - offset) / LAS_SCALE)
+    if intensity is not None:
+        records["intensity"] = np.clip(intensity, 0, 65535)
+    records["return_flags"] = 0b00001001  # return 1 of 1
+    return records.tobytes()
+
+
+def export_chunks(
+    reader: SweepReader,
+    format: str = "ply",
+    z_axis: str = "index",
+    summary: SweepSummary | None = None,
+    **scan_range,
+) -> Iterator[bytes]:
+    """Yield the encoded file, the header first and then one chunk of scans at a time.
+
+    Args:
+        reader: the sweep to export. Scans appended to a recording in progress after
+            the reader was opened are not exported.
+        format: "ply" or "las".
+        z_axis: "index", "time" or "sensor", see Z_AXES.
+        summary: the summary of the same reader and range, computed if None.
+        scan_range: start_time, end_time, start_seq and end_seq as for
+            SweepReader.scans.
+    """
+    assert format in EXPORT_FORMATS and z_axis in Z_AXES
+    if summary is None:
+        summary = summarize(reader, z_axis, **scan_range)
+
+    if format == "ply":
+        yield ply_header(summary)
+    else:
+        yield las_header(summary)
+
+    for x, y, z, intensity in _xyzi_chunks(reader, z_axis, **scan_range):
+        if not summary.has_intensity:
+            intensity = None
+        if format == "ply":
+            yield _encode_ply(x, y, z, intensity)
+        else:
+            yield _encode_las(x, y, z, intensity, summary.mins)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("sweep", help="the recorded sweep directory")
+    parser.add_argument("output", help="the .ply or .las file to write")
+    parser.add_argument("--z", choices=Z_AXES, default="index", help="the z axis")
+    args = parser.parse_args()
+
+    output_format = args.output.rsplit(".", 1)[-1].lower()
+    with SweepReader(args.sweep) as reader, open(args.output, "wb") as output:
+        for data in export_chunks(reader, output_format, args.z):
+            output.write(data)
+    print(args.output, flush=True)
@@ -0,0 +1,259 @@
+"""Binary WebSocket frames for streaming lidar points to the viewers.
+
+A frame is a fixed little-endian header, the comma separated field names padded
+to a 4 byte boundary, then one raw little-endian float32 array per field:
+
+    magic       4s   b"SCAN"
+    version     u8
+    num_fields  u8
+    names_len   u16  length of the field names in bytes (before padding)
+    seq         u32  header.seq of the scan
+    stamp_sec   u32  header.timestamp_sec
+    stamp_nsec  u32  header.timestamp_nsec
+    num_points  u32
+
+The arrays start at a 4 byte aligned offset so browsers can wrap them in a
+Float32Array without copying. The decoder lives in ts/src/scanFrame.js, which
+templates/simple_lidar.html loads from /scanFrame.js.
+
+Delta frames (format=delta) carry a scan as the difference from the last
+keyframe, a regular frame as above sent every KEYFRAME_INTERVAL scans:
+
+    magic       4s   b"SCND"
+    version     u8
+    num_fields  u8
+    names_len   u16
+    seq         u32
+    stamp_sec   u32
+    stamp_nsec  u32
+    num_points  u32
+    key_seq     u32  seq of the keyframe the deltas apply to
+    quantum     f32  the resolution of the deltas
+
+followed by the padded field names, one float64 offset per field, then one int16
+array per field. A value is keyframe + offset + delta * quantum, or NaN for a
+delta of DELTA_MISSING. As every delta frame refers to the keyframe, not to the
+previous frame, a dropped delta frame costs nothing; after a dropped keyframe
+the deltas are skipped until the next one.
+"""
+
+import struct
+from typing import NamedTuple
+
+import numpy as np
+
+FRAME_MAGIC = b"SCAN"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<4sBBHIIII")
+
+DELTA_MAGIC = b"SCND"
+DELTA_VERSION = 1
+DELTA_HEADER = struct.Struct("<4sBBHIIIIIf")
+DELTA_MISSING = -32768
+# the delta resolution (m), and the largest change from a keyframe is 32.767 m
+DELTA_QUANTUM = 0.001
+KEYFRAME_INTERVAL = 20
+
+
+class FrameHeader(NamedTuple):
+    """Header for frames that are not a single scan, e.g. the accumulated map."""
+
+    seq: int
+    timestamp_sec: int
+    timestamp_nsec: int
+
+    @classmethod
+    def from_ns(cls, seq: int, timestamp_ns: int) -> "FrameHeader":
+        sec, nsec = divmod(timestamp_ns, 1_000_000_000)
+        return cls(seq & 0xFFFFFFFF, sec, nsec)
+
+
+def _padded(length):
+    return (length + 3) & ~3
+
+
+def encode_points_frame(header, fields):
+    """Encode point arrays into a binary frame.
+
+    Args:
+        header: the scan header (anything with seq, timestamp_sec and timestamp_nsec).
+        fields (dict[str, np.ndarray]): equally sized point arrays keyed by field name.
+
+    Returns:
+        bytes: the encoded frame, ready for websocket.send_bytes.
+    """
+    names = ",".join(fields).encode("ascii")
+    num_points = len(next(iter(fields.values()))) if fields else 0
+
+    frame = bytearray(
+        FRAME_HEADER.pack(
+            FRAME_MAGIC,
+            FRAME_VERSION,
+            len(fields),
+            len(names),
+            header.seq,
+            header.timestamp_sec,
+            header.timestamp_nsec,
+            num_points,
+        )
+    )
+    frame += names.ljust(_padded(len(names)), b"\x00")
+    for values in fields.values():
+        assert len(values) == num_points
+        frame += np.asarray(values, dtype="<f4").tobytes()
+    return bytes(frame)
+
+
+def decode_points_frame(frame):
+    """Decode a binary frame back into its header and float32 point arrays.
+
+    Returns:
+        tuple[dict, dict[str, np.ndarray]]: the header values and the arrays, which
+        are read-only views into the frame.
+    """
+    magic, version, num_fields, names_len, seq, sec, nsec, num_points = (
+        FRAME_HEADER.unpack_from(frame)
+    )
+    assert magic == FRAME_MAGIC and version == FRAME_VERSION
+
+    offset = FRAME_HEADER.size
+    names = bytes(frame[offset : offset + names_len]).decode("ascii")
+    offset += _padded(names_len)
+
+    fields = {}
+    for name in names.split(",") if num_fields else []:
+        fields[name] = np.frombuffer(
+            frame, dtype="<f4", count=num_points, offset=offset
+        )
+        offset += 4 * num_points
+
+    header = {
+        "seq": seq,
+        "timestamp_sec": sec,
+        "timestamp_nsec": nsec,
+        "num_points": num_points,
+    }
+    return header, fields
+
+
+def _field_values(fields):
+    # the float32 values as sent in a keyframe, one row per field
+    return np.array(
+        [np.asarray(values, dtype=np.float32) for values in fields.values()],
+        dtype=np.float64,
+    )
+
+
+def _median(values):
+    if len(values) == 0:
+        return 0.0
+    middle = len(values) // 2
+    return float(np.partition(values, middle)[middle])
+
+
+class DeltaFrameEncoder:
+    """Encodes the scans of one stream as keyframes and delta frames.
+
+    A scan is sent as a keyframe every keyframe_interval scans, and whenever it
+    can not be a delta frame: its fields or number of points differ from the
+    keyframe, or a value changed by more than the int16 deltas hold.
+    """
+
+    def __init__(
+        self, keyframe_interval=KEYFRAME_INTERVAL, quantum=DELTA_QUANTUM
+    ) -> None:
+        self.keyframe_interval = max(1, keyframe_interval)
+        # as sent in the frames, so both sides use the same value
+        self.quantum = float(np.float32(quantum))
+        self.keyframes = 0
+        self.delta_frames = 0
+        self._key_seq = 0
+        self._key_names = None
+        self._key_values = None
+        self._since_keyframe = 0
+
+    def request_keyframe(self) -> None:
+        """Send the next scan as a keyframe, e.g. for a new viewer."""
+        self._key_names = None
+
+    def encode(self, header, fields):
+        """Encode point arrays into a keyframe or a delta frame.
+
+        Args:
+            header: the scan header (anything with seq, timestamp_sec and
+                timestamp_nsec).
+            fields (dict[str, np.ndarray]): equally sized point arrays keyed by
+                field name.
+
+        Returns:
+            bytes: the encoded frame, ready for websocket.send_bytes.
+        """
+        if (
+            self._key_names is not None
+            and self._since_keyframe < self.keyframe_interval
+        ):
+            frame = self._encode_delta(header, fields)
+            if frame is not None:
+                self._since_keyframe += 1
+                self.delta_frames += 1
+                return frame
+
+        self._key_seq = header.seq
+        self._key_names = list(fields)
+        self._key_values = _field_values(fields)
+        self._since_keyframe = 1
+        self.keyframes += 1
+        return encode_points_frame(header, fields)
+
+    def _encode_delta(self, header, fields):
+        if not fields or list(fields) != self._key_names:
+            return None
+        values = _field_values(fields)
+        if values.shape != self._key_values.shape:
+            return None
+        num_points = values.shape[1]
+
+        change = values - self._key_values
+        missing = ~np.isfinite(values)
+        any_missing = missing.any()
+        if any_missing:
+            change[missing] = 0.0
+        if not np.isfinite(change).all():
+            return None  # a value the keyframe was missing
+
+        # a shift of the whole field, e.g. the sweep time z, costs no deltas.
+        # The median of every 16th point is close enough and much cheaper.
+        samples = change[:, ::16]
+        if any_missing:
+            samples = [row[keep] for row, keep in zip(samples, ~missing[:, ::16])]
+        offsets = np.array([_median(sample) for sample in samples])
+
+        deltas = np.round((change - offsets[:, None]) / self.quantum)
+        if num_points and np.abs(deltas).max() > 32767:
+            return None
+        deltas = deltas.astype("<i2")
+        if any_missing:
+            deltas[missing] = DELTA_MISSING
+
+        names = ",".join(fields).encode("ascii")
+        frame = bytearray(
+            DELTA_HEADER.pack(
+                DELTA_MAGIC,
+                DELTA_VERSION,
+                len(fields),
+                len(names),
+                header.seq,
+                header.timestamp_sec,
+                header.timestamp_nsec,
+                num_points,
+                self._key_seq,
+                self.quantum,
+            )
+        )
+        frame += names.ljust(_padded(len(names)), b"\x00")
+        frame += offsets.astype("<f8").tobytes()
+        frame += deltas.tobytes()  # one array per field
+        return bytes(frame)
+
+    def stats(self) -> dict:
+        return {"keyframes": self.keyframes, "delta_frames": self.delta_frames}
@@ -0,0 +1,207 @@
+"""Latency histograms of the lidar pipeline stages, in the Prometheus text format.
+
+Two histogram families are recorded:
+
+    lidar_stage_seconds{stage}    the time spent in a stage, e.g. to_proto
+    lidar_scan_age_seconds{stage} the time from a scan's header timestamp until it
+                                  reached a stage, i.e. the latency since the lidar
+
+Scans are keyed by (source, header.seq), so stages which no longer have the
+header at hand (e.g. the websocket send of an encoded frame) still find the
+timestamp of their scan. As the lidar service and the app stamp the same
+scans, their ages add up to the end-to-end latency from the lidar to the browser.
+
+Recording is off by default, every hook is then a single attribute check:
+
+    start = metrics.clock()
+    protocolbuf = to_proto(contents)
+    metrics.stage("to_proto", start)
+"""
+
+from __future__ import annotations
+
+import asyncio
+import bisect
+import collections
+import threading
+import time
+from typing import Hashable, NamedTuple
+
+# upper bounds (s) of the histogram buckets, from 50 us to 10 s
+BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+# scans whose timestamps are remembered for the later stages
+MAX_SCANS = 4096
+
+STAGE_SECONDS = "lidar_stage_seconds"
+SCAN_AGE_SECONDS = "lidar_scan_age_seconds"
+HELP = {
+    STAGE_SECONDS: "Time spent in each stage of the lidar pipeline.",
+    SCAN_AGE_SECONDS: "Time from the scan header timestamp until each stage.",
+}
+
+
+class Histogram:
+    """Counts of observations per bucket, with their sum."""
+
+    def __init__(self, buckets: tuple = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class TracedFrame(NamedTuple):
+    """An encoded frame with the key of its scan, so its send can be recorded."""
+
+    frame: bytes | str
+    key: Hashable
+
+
+class LatencyMetrics:
+    """The stage histograms of one process, safe to record from any thread."""
+
+    def __init__(self, max_scans: int = MAX_SCANS) -> None:
+        self.enabled = False
+        self._max_scans = max_scans
+        self._lock = threading.Lock()
+        self._histograms: dict[tuple[str, str], Histogram] = {}
+        self._timestamps: collections.OrderedDict = collections.OrderedDict()
+
+    def enable(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+
+    def clock(self) -> float:
+        """The start of a stage, for stage()."""
+        return time.perf_counter() if self.enabled else 0.0
+
+    def stage(self, stage: str, start: float) -> None:
+        """Record the time spent in stage since start, a clock() value."""
+        if self.enabled:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """Record the time spent in stage, when it is measured anyway."""
+        if self.enabled:
+            with self._lock:
+                self._histogram(STAGE_SECONDS, stage).observe(seconds)
+
+    def scan(self, key: Hashable, stage: str, timestamp_ns: int | None = None) -> None:
+        """Record the age of the scan key, e.g. (lidar, seq), as it reaches stage.
+
+        Args:
+            key: identifies the scan within this process.
+            stage: the name of the stage.
+            timestamp_ns: the header timestamp of the scan, needed the first time
+                the scan is seen. Scans never seen with one are not recorded.
+        """
+        if not self.enabled:
+            return
+        now_ns = time.time_ns()
+        with self._lock:
+            if timestamp_ns is None:
+                timestamp_ns = self._timestamps.get(key)
+                if timestamp_ns is None:
+                    return
+            elif key not in self._timestamps:
+                self._timestamps[key] = timestamp_ns
+                if len(self._timestamps) > self._max_scans:
+                    self._timestamps.popitem(last=False)
+            self._histogram(SCAN_AGE_SECONDS, stage).observe(
+                (now_ns - timestamp_ns) / 1e9
+            )
+
+    def _histogram(self, name: str, stage: str) -> Histogram:
+        histogram = self._histograms.get((name, stage))
+        if histogram is None:
+            histogram = self._histograms[(name, stage)] = Histogram()
+        return histogram
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._timestamps.clear()
+
+    def render(self) -> str:
+        """The histograms in the Prometheus text exposition format."""
+        lines = [
+            "# HELP lidar_metrics_enabled Whether the latencies are being recorded.",
+            "# TYPE lidar_metrics_enabled gauge",
+            f"lidar_metrics_enabled {int(self.enabled)}",
+        ]
+        with self._lock:
+            for name in (STAGE_SECONDS, SCAN_AGE_SECONDS):
+                lines.append(f"# HELP {name} {HELP[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for (family, stage), histogram in sorted(self._histograms.items()):
+                    if family == name:
+                        lines.extend(histogram.render(name, f'stage="{stage}"'))
+        return "\n".join(lines) + "\n"
+
+
+# the metrics of this process
+metrics = LatencyMetrics()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+async def serve_metrics(port: int, host: str = "0.0.0.0") -> None:  # noqa: S104
+    """Serve GET /metrics over plain HTTP, for processes without a web server."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = (await reader.readline()).split()
+            # the request headers are not needed
+            while (await reader.readline()).strip():
+                pass
+            if len(request) >= 2 and request[1].split(b"?")[0] == b"/metrics":
+                status, body = b"200 OK", metrics.render().encode()
+            else:
+                status, body = b"404 Not Found", b"not found\n"
+            writer.write(
+                b"HTTP/1.1 " + status + b"\r\n"
+                b"Content-Type: " + CONTENT_TYPE.encode() + b"\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
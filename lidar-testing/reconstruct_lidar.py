@@ -1,75 +1,148 @@
+import argparse
 import datetime
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import open3d as o3d
-
-import lidar_pb2
-from utils import from_proto, pySickScanCartesianPointCloudMsgToXYZ
 from tqdm import tqdm
 
-# Make sure sick_scan_api is searched in all folders configured in environment variable PYTHONP>
-def appendPythonPath():
-    pythonpath = os.environ["PYTHONPATH"]
-    for folder in pythonpath.split(";"):
-        sys.path.append(os.path.abspath(folder))
-
-
-try:
-    # import sick_scan_api
-    from sick_scan_api import *
-except ModuleNotFoundError:
-    print(
-        "import sick_scan_api failed, module sick_scan_api not found, trying with importlib"
-    )
-    appendPythonPath()
-    import importlib
-
-    sick_scan_api = importlib.import_module("sick_scan_api")
+# use the conversion and sweep reader modules of the app in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from pointcloud import pySickScanCartesianPointCloudMsgToXYZ
+from sweep_reader import SweepReader
 
-def read_and_parse_all_files(directory):
-    parsed_data = []
-    for file_name in sorted(os.listdir(directory)):
-        file_path = os.path.join(directory, file_name)
+OUTPUT_DIRECTORY = "/mnt/managed_home/farm-ng-user-gsainsbury/amiga-fastapi"
 
-        with open(file_path, "rb") as binary_file:
-            binary_data = binary_file.read()
-            parsed_data.append(binary_data)
-    return parsed_data
 
+def scan_points(x_vals, y_vals, i):
+    # the lidar does not know how it moves, so the scan index is used as z
+    return np.column_stack((x_vals, y_vals, np.full(len(x_vals), i / 100)))
 
-# Replace "directory_path" with the path to the directory containing binary files
-for lidar in ["102", "103"]:
-    directory = f"Lidar_{lidar}_data"
-    current_directory = os.path.dirname(os.path.abspath(__file__))
 
-    lidar_directory = os.path.join(current_directory, directory)
+def reconstruct_chunk(directory, start, stop):
+    """Convert the scans at positions start to stop to an (N, 3) array of points."""
+    chunk = []
+    with SweepReader(directory) as reader:
+        for i, protocolbuf in enumerate(reader.scans_at(start, stop), start):
+            x_vals, y_vals, _ = pySickScanCartesianPointCloudMsgToXYZ(protocolbuf)
+            chunk.append(scan_points(x_vals, y_vals, i))
+    return np.concatenate(chunk) if chunk else np.zeros((0, 3))
 
-    print(lidar_directory)
-
-    parsed_data = read_and_parse_all_files(lidar_directory)
 
+def reconstruct_serial(directory):
+    """The original one scan at a time reconstruction, kept as a reference."""
     pcd = o3d.geometry.PointCloud()
+    with SweepReader(directory) as reader:
+        for i, protocolbuf in tqdm(enumerate(reader.scans()), total=len(reader)):
+
+            start_time = None
+
+            x_vals, y_vals, z_vals = pySickScanCartesianPointCloudMsgToXYZ(
+                protocolbuf, start_time
+            )
+            xyz_points = np.array(
+                [[x, y, i / 100] for x, y, z in zip(x_vals, y_vals, z_vals)]
+            )
+            pcd.points.extend(o3d.utility.Vector3dVector(xyz_points))
+
+        num_scans = len(reader)
+
+    return pcd, num_scans
+
+
+def reconstruct_parallel(directories, workers, chunk_size):
+    """Reconstruct several recordings at once, split in chunks over a process pool.
+
+    Returns:
+        dict: the point cloud and number of scans for each directory.
+    """
+    chunks = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for directory in directories:
+            with SweepReader(directory) as reader:
+                num_scans = len(reader)
+            chunks[directory] = (
+                num_scans,
+                [
+                    executor.submit(
+                        reconstruct_chunk, directory, start, start + chunk_size
+                    )
+                    for start in range(0, num_scans, chunk_size)
+                ],
+            )
+
+        results = {}
+        for directory, (num_scans, futures) in chunks.items():
+            points = [future.result() for future in tqdm(futures, desc=directory)]
+            pcd = o3d.geometry.PointCloud()
+            if points:
+                pcd.points = o3d.utility.Vector3dVector(np.concatenate(points))
+            results[directory] = (pcd, num_scans)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Reconstruct recorded lidar sweeps into PLY point clouds."
+    )
+    parser.add_argument(
+        "--lidars", nargs="+", default=["102", "103"], help="the lidars to reconstruct"
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=str,
+        default=os.path.dirname(os.path.abspath(__file__)),
+        help="the directory containing the Lidar_<lidar>_data recordings",
+    )
+    parser.add_argument(
+        "--output-dir", type=str, default=OUTPUT_DIRECTORY, help="where to write PLYs"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="the number of processes"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=500, help="the number of scans per task"
+    )
+    parser.add_argument(
+        "--serial", action="store_true", help="use the original serial reconstruction"
+    )
+    args = parser.parse_args()
+
+    lidar_directories = {
+        lidar: os.path.join(args.data_dir, f"Lidar_{lidar}_data")
+        for lidar in args.lidars
+    }
+
+    start = time.perf_counter()
+    if args.serial:
+        results = {}
+        for directory in lidar_directories.values():
+            print(directory)
+            results[directory] = reconstruct_serial(directory)
+    else:
+        results = reconstruct_parallel(
+            list(lidar_directories.values()), args.workers, args.chunk_size
+        )
+    elapsed = time.perf_counter() - start
 
-    for i, datum in tqdm(enumerate(parsed_data), total=len(parsed_data)):
-
-        protocolbuf = lidar_pb2.SickScanPointCloudMsg()
-        protocolbuf.ParseFromString(datum)
-
-        pointcloud_msg = from_proto(protocolbuf)
-
-        start_time = None
+    total_scans = 0
+    for lidar, directory in lidar_directories.items():
+        pcd, num_scans = results[directory]
+        total_scans += num_scans
 
-        x_vals, y_vals, z_vals = pySickScanCartesianPointCloudMsgToXYZ(
-            pointcloud_msg, start_time
-        )
-        xyz_points = np.array(
-            [[x, y, i / 100] for x, y, z in zip(x_vals, y_vals, z_vals)]
+        filename = os.path.join(
+            args.output_dir,
+            f'lidar_{lidar}_{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.ply',
         )
-        pcd.points.extend(o3d.utility.Vector3dVector(xyz_points))
+        o3d.io.write_point_cloud(filename, pcd)
+        print(filename, flush=True)
 
-    filename = f'/mnt/managed_home/farm-ng-user-gsainsbury/amiga-fastapi/lidar_{lidar}_{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.ply'
-    o3d.io.write_point_cloud(filename, pcd)
-    print(filename, flush=True)
+    print(
+        f"Reconstructed {total_scans} scans in {elapsed:.1f} s, "
+        f"{total_scans / elapsed:.1f} scans/s",
+        flush=True,
+    )
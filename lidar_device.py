@@ -0,0 +1,168 @@
+"""The capture and publishing pipeline of one lidar of the lidar service.
+
+Each LidarDevice has its own sick_scan API handle and callback, its own
+ScanWriter (and so its own ScanRing) during a capture, and its own bounded
+queue of scans to publish on its /data URI, so lidars never wait on each other.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+from google.protobuf.message import Message
+
+from latency import metrics
+from scan_log import scan_timestamp_ns
+from scan_writer import ScanLogSink, ScanWriter
+from sick_driver import SickScanDriver, launch_args
+
+PUBLISH_RATE = 600
+
+
+def parse_lidar_addresses(addresses: list[str]) -> list[tuple[str, str]]:
+    """Parse NAME=ADDRESS (or ADDRESS) arguments into (name, address) pairs.
+
+    Without a name a lidar is named after the last part of its address, e.g. 102
+    for 10.95.76.102, as in the Lidar_102_data recordings.
+    """
+    lidars = []
+    for address in addresses:
+        name, _, host = address.rpartition("=")
+        lidars.append((name or host.rsplit(".", 1)[-1], host))
+    return lidars
+
+
+class LidarDevice:
+    """One lidar: its driver, the writer of the current capture and its publishing."""
+
+    def __init__(
+        self,
+        name: str,
+        lidar_address: str,
+        publish_uri: str,
+        publish_rate: float = PUBLISH_RATE,
+        queue_size: int = 8,
+        logger: logging.Logger | None = None,
+        codec: str | None = None,
+    ) -> None:
+        """Initialize the device, without connecting to the lidar.
+
+        Args:
+            name: The name of the lidar, e.g. 102.
+            lidar_address: The IP address of the lidar.
+            publish_uri: The event service path to publish the scans on, e.g. /data/102.
+            publish_rate: The maximum rate (Hz) at which scans are published, faster
+                scans are decimated. Zero or less publishes every scan.
+            queue_size: The number of scans buffered for publishing before the
+                oldest are dropped.
+            logger: The logger of the service.
+            codec: The compression of the recorded scans, see scan_codec.py, None
+                to record them uncompressed.
+        """
+        self.name = name
+        self.publish_uri = publish_uri
+        self.driver = SickScanDriver(launch_args(lidar_address), self.on_pointcloud)
+        self.logger = logger or logging.getLogger(__name__)
+        self.codec = codec
+
+        # the writer of the current capture, fed from the sick_scan callback thread
+        self.writer: ScanWriter | None = None
+
+        self._publish_period: float = 1.0 / publish_rate if publish_rate > 0 else 0.0
+        self._last_accepted: float = 0.0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._scans: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+        self.scans_received = 0
+        self.scans_decimated = 0
+        self.scans_dropped = 0
+        self.scans_published = 0
+
+    def on_pointcloud(self, api_handle, pointcloud_msg) -> None:
+        """
+        Implement a callback to process pointcloud messages
+        Only the raw scan is copied here, conversion and disk writes happen in scan_writer
+        """
+        if metrics.enabled:
+            header = pointcloud_msg.contents.header
+            metrics.scan((self.name, header.seq), "callback", scan_timestamp_ns(header))
+        writer = self.writer
+        if writer is not None:
+            writer.submit(pointcloud_msg.contents)
+
+    def submit_scan(self, scan: Message) -> None:
+        """Hand a scan over to the event loop for publishing.
+
+        Called from the scan_writer thread, so it must not touch the queue directly.
+        """
+        self.scans_received += 1
+        if self._loop is None:
+            return
+
+        now = time.monotonic()
+        if now - self._last_accepted < self._publish_period:
+            self.scans_decimated += 1
+            return
+        self._last_accepted = now
+
+        self._loop.call_soon_threadsafe(self._enqueue_scan, scan)
+
+    def _enqueue_scan(self, scan: Message) -> None:
+        if self._scans.full():
+            # keep the freshest scans, the oldest one is dropped
+            self._scans.get_nowait()
+            self.scans_dropped += 1
+        self._scans.put_nowait(scan)
+
+    async def publish(self, event_service) -> None:
+        """Publish every scan on publish_uri as soon as it arrives."""
+        self._loop = asyncio.get_running_loop()
+
+        while True:
+            scan = await self._scans.get()
+            start = metrics.clock()
+            await event_service.publish(self.publish_uri, scan)
+            metrics.stage("publish", start)
+            metrics.scan((self.name, scan.header.seq), "publish")
+            self.scans_published += 1
+
+    async def start_capture(self, directory: str) -> None:
+        """Start writing the scans to directory, connecting to the lidar if needed."""
+        loop = asyncio.get_running_loop()
+        writer = ScanWriter(
+            ScanLogSink(directory, codec=self.codec),
+            on_scan=self.submit_scan,
+            logger=self.logger,
+        )
+        writer.start()
+        self.writer = writer
+
+        # only the first capture loads the library and connects, which blocks a while
+        await loop.run_in_executor(None, self.driver.open)
+        await loop.run_in_executor(None, self.driver.register)
+
+    async def stop_capture(self) -> None:
+        """Stop delivering scans and wait until they are written."""
+        loop = asyncio.get_running_loop()
+        # the driver stays open, so the next capture starts right away
+        await loop.run_in_executor(None, self.driver.deregister)
+
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            # flush the remaining scans without blocking the event loop
+            await loop.run_in_executor(None, writer.stop)
+            self.logger.info(f"{self.name} scan writer: {writer.stats()}")
+
+    def stats(self) -> dict:
+        stats = {
+            "driver_open": self.driver.is_open,
+            "scans_received": self.scans_received,
+            "scans_published": self.scans_published,
+            "scans_decimated": self.scans_decimated,
+            "publish_dropped": self.scans_dropped,
+        }
+        if self.writer is not None:
+            stats.update(self.writer.stats())
+        return stats
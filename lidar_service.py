@@ -11,10 +11,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from __future__ import annotations
 
 import argparse
 import asyncio
 import logging
+import os
+import time
 from datetime import datetime
 from pathlib import Path
 
@@ -23,99 +26,195 @@ from farm_ng.core.event_pb2 import Event
 from farm_ng.core.event_service import EventServiceGrpc
 from farm_ng.core.event_service_pb2 import EventServiceConfig
 from farm_ng.core.events_file_reader import proto_from_json_file
-from google.protobuf.empty_pb2 import Empty
 from google.protobuf.message import Message
-from sick_scan_api import *
+from google.protobuf.struct_pb2 import Struct
+from google.protobuf.wrappers_pb2 import DoubleValue
 
-from utils import sick_scan_library, api_handle, to_proto
+from latency import metrics, serve_metrics
+from lidar_device import PUBLISH_RATE, LidarDevice, parse_lidar_addresses
+from replay import SweepReplay
+from scan_codec import SCAN_CODECS
+from scan_writer import DATE_FORMAT
 
-DATE_FORMAT = "%Y-%m-%d_%H-%M-%S_%f"
-PUBLISH_RATE = 600
-
-
-def pyCustomizedPointCloudMsgCb(api_handle, pointcloud_msg):
-    """
-    Implement a callback to process pointcloud messages
-    Data processing to be done
-    """
-    global lidar_buffer, BASE_DIR
-
-    new_file_path = os.path.join(BASE_DIR, datetime.now().strftime(DATE_FORMAT))
-
-    with open(new_file_path, "ab") as file:
-        protocol_buffer = to_proto(pointcloud_msg.contents)
-        file.write(protocol_buffer.SerializeToString())
-
-    lidar_buffer = protocol_buffer
+SCAN_DURATION = 60.0
+RECORDINGS_DIRECTORY = "/mnt/managed_home/farm-ng-user-gsainsbury"
 
 
 class LIDARServer:
 
-    def __init__(self, event_service: EventServiceGrpc) -> None:
-        global lidar_buffer
+    def __init__(
+        self,
+        event_service: EventServiceGrpc,
+        devices: list[LidarDevice],
+        scan_duration: float = SCAN_DURATION,
+        recordings_directory: str = RECORDINGS_DIRECTORY,
+        metrics_port: int = 0,
+        replay: SweepReplay | None = None,
+    ) -> None:
         """Initialize the service.
 
         Args:
             event_service: The event service to use for communication.
+            devices: The lidars, whose drivers are opened when the first capture
+                starts and kept open until the service exits.
+            scan_duration: The default length (s) of a capture, zero or less to
+                capture until /stop_scan.
+            recordings_directory: Where the lidar_<date> capture directories are
+                written, with a subdirectory per lidar when there are several.
+            metrics_port: The port serving the latency histograms on /metrics, 0
+                for none.
+            replay: A recording published in place of the scans of the lidars,
+                in which case devices is empty and there is nothing to capture.
         """
         self._event_service = event_service
         self._event_service.add_request_reply_handler(self.request_reply_handler)
-
-        self._counter = 0
-        self._rate: float = 1.0
-        lidar_buffer = None
+        self._devices = devices
+        self._scan_duration = scan_duration
+        self._recordings_directory = recordings_directory
+        self._metrics_port = metrics_port
+        self._replay = replay
+
+        # the current capture, see start_capture
+        self._capture: asyncio.Task | None = None
+        self._capture_stop = asyncio.Event()
+        self._capture_directory: str | None = None
+        self._capture_started: float = 0.0
+        self._capture_duration: float = 0.0
+        self._capture_state = "idle"
 
     @property
     def logger(self) -> logging.Logger:
         """Return the logger for this service."""
         return self._event_service.logger
 
-    async def request_reply_handler(self, event: Event, message: Message) -> None:
-        global lidar_buffer, BASE_DIR
-        """The callback for handling request/reply messages."""
-        if event.uri.path == "/start_scan":
+    async def request_reply_handler(self, event: Event, message: Message) -> Message:
+        """The callback for handling request/reply messages.
 
-            asyncio.create_task(self.perform_lidar_sweep())
+        /start_scan starts a capture, for DoubleValue seconds if the request is one
+            (zero for a continuous capture), for scan_duration otherwise.
+        /stop_scan stops the current capture once its scans are written.
+        /status only reports the capture status.
 
-        return Empty()
+        Every request is answered with the capture status, see status().
+        """
+        if event.uri.path == "/start_scan":
+            duration = (
+                message.value
+                if isinstance(message, DoubleValue)
+                else self._scan_duration
+            )
+            self.start_capture(duration)
+        elif event.uri.path == "/stop_scan":
+            await self.stop_capture()
+
+        reply = Struct()
+        reply.update(self.status())
+        return reply
 
-    async def perform_lidar_sweep(self):
-        global BASE_DIR, lidar_buffer
-        SickScanApiInitByLaunchfile(sick_scan_library, api_handle, cli_args_for_sick)
-        # Register for pointcloud messages
-        cartesian_pointcloud_callback = SickScanPointCloudMsgCallback(
-            pyCustomizedPointCloudMsgCb
-        )
-        SickScanApiRegisterCartesianPointCloudMsg(
-            sick_scan_library, api_handle, cartesian_pointcloud_callback
-        )
-        BASE_DIR = f"/mnt/managed_home/farm-ng-user-gsainsbury/lidar_{datetime.now().strftime(DATE_FORMAT)}"
-        os.makedirs(BASE_DIR, exist_ok=True)
-        await asyncio.sleep(60)
-        lidar_buffer = None
-        SickScanApiDeregisterCartesianPointCloudMsg(
-            sick_scan_library,
-            api_handle,
-            cartesian_pointcloud_callback,
+    @property
+    def capturing(self) -> bool:
+        return self._capture is not None and not self._capture.done()
+
+    def status(self) -> dict:
+        """The capture state ("idle", "starting", "capturing" or "stopping") and the
+        stats of each lidar, and of the replay if any."""
+        status = {
+            "state": self._capture_state,
+            "directory": self._capture_directory or "",
+            "duration": self._capture_duration,
+            "elapsed": (
+                time.monotonic() - self._capture_started
+                if self._capture_state == "capturing"
+                else 0.0
+            ),
+            "lidars": {device.name: device.stats() for device in self._devices},
+        }
+        if self._replay is not None:
+            status["replay"] = self._replay.stats()
+        return status
+
+    def _device_directory(self, device: LidarDevice) -> str:
+        if len(self._devices) == 1:
+            return self._capture_directory
+        return os.path.join(self._capture_directory, device.name)
+
+    def start_capture(self, duration: float) -> bool:
+        """Start capturing for duration seconds, or until stop_capture if <= 0.
+
+        Returns:
+            False if a capture is already running, which is left unchanged, or if
+            there are no lidars (replaying).
+        """
+        if self.capturing or not self._devices:
+            return False
+        self._capture_stop.clear()
+        self._capture_duration = max(duration, 0.0)
+        self._capture_directory = os.path.join(
+            self._recordings_directory,
+            f"lidar_{datetime.now().strftime(DATE_FORMAT)}",
         )
-        SickScanApiClose(sick_scan_library, api_handle)
-        SickScanApiRelease(sick_scan_library, api_handle)
-        SickScanApiUnloadLibrary(sick_scan_library)
+        self._capture_state = "starting"
+        self._capture = asyncio.create_task(self._run_capture(self._capture_duration))
+        return True
+
+    async def stop_capture(self) -> None:
+        """Stop the current capture and wait until its scans are written."""
+        if self.capturing:
+            self._capture_stop.set()
+            await asyncio.wait({self._capture})
+
+    async def _run_capture(self, duration: float) -> None:
+        try:
+            # the lidars connect concurrently, the first capture blocks a while
+            await asyncio.gather(
+                *(
+                    device.start_capture(self._device_directory(device))
+                    for device in self._devices
+                )
+            )
+            self._capture_started = time.monotonic()
+            self._capture_state = "capturing"
+            self.logger.info(f"capturing to {self._capture_directory}")
+
+            try:
+                await asyncio.wait_for(
+                    self._capture_stop.wait(), timeout=duration or None
+                )
+            except asyncio.TimeoutError:
+                pass
+        except Exception:
+            self.logger.exception(f"capture to {self._capture_directory} failed")
+        finally:
+            self._capture_state = "stopping"
+            await asyncio.gather(*(device.stop_capture() for device in self._devices))
+            self._capture_state = "idle"
 
     async def run(self) -> None:
-        """Run the main task."""
-        global lidar_buffer
-
+        """Run the main task, publishing the scans of every lidar as they arrive."""
+        tasks = [device.publish(self._event_service) for device in self._devices]
+        if self._replay is not None:
+            tasks.append(self._replay.publish(self._event_service))
+        await asyncio.gather(*tasks)
+
+    async def log_stats(self, period: float = 10.0) -> None:
+        """Periodically log how many scans were published, decimated and dropped."""
         while True:
-
-            if lidar_buffer is not None:
-                await self._event_service.publish("/data", lidar_buffer)
-                lidar_buffer = None
-
-            await asyncio.sleep(1.0 / self._rate)
+            await asyncio.sleep(period)
+            for device in self._devices:
+                self.logger.info(f"lidar {device.name}: {device.stats()}")
+            if self._replay is not None:
+                self.logger.info(f"replay: {self._replay.stats()}")
 
     async def serve(self) -> None:
-        await asyncio.gather(self._event_service.serve(), self.run())
+        tasks = [self._event_service.serve(), self.run(), self.log_stats()]
+        if self._metrics_port:
+            tasks.append(serve_metrics(self._metrics_port))
+        await asyncio.gather(*tasks)
+
+    def close(self) -> None:
+        """Close the drivers and unload the sick_scan library."""
+        for device in self._devices:
+            device.driver.close()
 
 
 # async def shutdown(loop, event_service):
@@ -131,12 +230,89 @@ if __name__ == "__main__":
         "--service-config", type=Path, required=True, help="The service config."
     )
     parser.add_argument(
-        "--lidar_address", type=str, required=True, help="The Lidar IP address"
+        "--lidar_address",
+        type=str,
+        nargs="+",
+        default=[],
+        help="The Lidar IP address, or NAME=ADDRESS for each of several lidars, "
+        "published on /data/NAME",
+    )
+    parser.add_argument(
+        "--publish-rate",
+        type=float,
+        default=PUBLISH_RATE,
+        help="The maximum rate (Hz) to publish the scans of each lidar, 0 to publish "
+        "every scan",
+    )
+    parser.add_argument(
+        "--publish-queue-size",
+        type=int,
+        default=8,
+        help="The number of scans buffered for publishing before dropping the oldest",
+    )
+    parser.add_argument(
+        "--scan-duration",
+        type=float,
+        default=SCAN_DURATION,
+        help="The length (s) of a capture started by /start_scan, 0 to capture "
+        "until /stop_scan",
+    )
+    parser.add_argument(
+        "--recordings-dir",
+        type=str,
+        default=RECORDINGS_DIRECTORY,
+        help="The directory to write the lidar_<date> captures to",
+    )
+    parser.add_argument(
+        "--open-on-start",
+        action="store_true",
+        help="Connect to the lidar when the service starts, not on the first capture",
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--codec",
+        choices=SCAN_CODECS,
+        default=None,
+        help="Compress the point data of the recorded scans, see scan_codec.py",
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="Record the latency of each stage of the scans, see latency.py",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="The port to serve the Prometheus /metrics on, 0 for none",
+    )
+
+    parser.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        help="Publish this recorded sweep (or capture of several lidars) instead of "
+        "the scans of the lidars",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="How many times faster than recorded to replay, 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--replay-repeat", action="store_true", help="Replay the recording in a loop"
+    )
+    parser.add_argument(
+        "--replay-restamp",
+        action="store_true",
+        help="Stamp the replayed scans with the time they are published",
+    )
 
-    cli_args_for_sick = f"/mnt/managed_home/farm-ng-user-gsainsbury/amiga-fastapi/sick_scan_ws/sick_scan_xd/launch/sick_lms_4xxx.launch hostname:={args.lidar_address}"
+    args = parser.parse_args()
+    if bool(args.lidar_address) == bool(args.replay):
+        parser.error("either --lidar_address or --replay is required")
+    metrics.enable(args.metrics)
 
     # load the service config
     service_config: EventServiceConfig = proto_from_json_file(
@@ -150,9 +326,43 @@ if __name__ == "__main__":
 
     loop = asyncio.get_event_loop()
 
+    # a single lidar keeps publishing on /data, several on /data/<name>
+    lidars = parse_lidar_addresses(args.lidar_address)
+    devices = [
+        LidarDevice(
+            name,
+            address,
+            "/data" if len(lidars) == 1 else f"/data/{name}",
+            args.publish_rate,
+            args.publish_queue_size,
+            event_service.logger,
+            args.codec,
+        )
+        for name, address in lidars
+    ]
+    replay = (
+        SweepReplay(
+            args.replay,
+            args.replay_speed,
+            args.replay_repeat,
+            args.replay_restamp,
+            event_service.logger,
+        )
+        if args.replay
+        else None
+    )
+    lidar_service = LIDARServer(
+        event_service,
+        devices,
+        args.scan_duration,
+        args.recordings_dir,
+        args.metrics_port,
+        replay,
+    )
     try:
-
-        lidar_service = LIDARServer(event_service)
+        if args.open_on_start:
+            for device in devices:
+                device.driver.open()
 
         # for sig in (signal.SIGTERM, signal.SIGINT):
         #     loop.add_signal_handler(
@@ -165,4 +375,5 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print("Exiting...")
     finally:
+        lidar_service.close()
         loop.close()
@@ -15,11 +15,15 @@ from __future__ import annotations
 
 import argparse
 import asyncio
-import json
+import itertools
 import logging
+import os
+import time
 from datetime import datetime
 from pathlib import Path
+from typing import NamedTuple, Optional
 
+import numpy as np
 import uvicorn
 from farm_ng.core.event_client import EventClient
 from farm_ng.core.event_service_pb2 import EventServiceConfigList
@@ -29,13 +33,31 @@ from farm_ng.core.uri_pb2 import Uri
 from fastapi import FastAPI
 from fastapi import WebSocket, Request, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from google.protobuf.empty_pb2 import Empty
-from google.protobuf.json_format import MessageToJson
-
-from utils import pySickScanCartesianPointCloudMsgToXYZ
+from google.protobuf.json_format import MessageToDict
+
+from accumulator import MAX_POINTS, WINDOW_SECONDS, ScanAccumulator
+from broadcast import Broadcaster, OverflowPolicy, SendQueue
+from columnar import COLUMNAR_FORMATS, export_columnar
+from downsample import PointReduction
+from export import EXPORT_FORMATS, Z_AXES, export_chunks, summarize
+from frames import DeltaFrameEncoder, FrameHeader, encode_points_frame
+from latency import CONTENT_TYPE, TracedFrame, metrics
+from merge import (
+    TOLERANCE_NS,
+    MergedScan,
+    ScanMerger,
+    lidar_directories,
+    load_extrinsics,
+    transform_points,
+)
+from pointcloud import pySickScanCartesianPointCloudMsgToXYZ
+from scan_log import is_scan_log, scan_timestamp_ns
+from sweep_reader import SweepReader
+from topic_encoders import TOPIC_FORMATS, dumps_json, encode_message
 
 logger = logging.getLogger("uvicorn")
 
@@ -59,14 +81,84 @@ async def simple_lidar(request: Request):
     return templates.TemplateResponse("simple_lidar.html", {"request": request})
 
 
+@app.get("/scanFrame.js")
+async def scan_frame_js():
+    """The frame decoder of the React app, for templates/simple_lidar.html."""
+    return FileResponse(
+        Path(__file__).parent / "ts" / "src" / "scanFrame.js",
+        media_type="text/javascript",
+    )
+
+
 # to store the events clients
 clients: dict[str, EventClient] = {}
 
 
+class ServiceUris(NamedTuple):
+    """The last uris listed by an event service."""
+
+    uris: dict  # the uri protos as json dicts, keyed by the uri full path
+    reachable: bool  # whether the service answered the last query
+    updated: float  # time.monotonic() of the last successful query
+
+
+# the uris of each service, refreshed in the background when older than URIS_TTL
+URIS_TTL = 2.0
+URIS_TIMEOUT = 0.1
+service_uris: dict[str, ServiceUris] = {}
+uris_refreshed = 0.0
+uris_refresh: asyncio.Task | None = None
+
+
+async def _query_uris(service_name: str, client: EventClient) -> None:
+    previous = service_uris.get(service_name, ServiceUris({}, False, 0.0))
+    try:
+        # NOTE: some services may not be available, so we need to handle the timeout
+        uris: list[Uri] = await asyncio.wait_for(
+            client.list_uris(), timeout=URIS_TIMEOUT
+        )
+    except Exception:  # noqa: BLE001
+        # timeouts, or gRPC errors when the service is down
+        service_uris[service_name] = previous._replace(reachable=False)
+        return
+
+    # convert the uris to a dict, where the key is the uri full path
+    # and the value is the uri proto as a json dict
+    service_uris[service_name] = ServiceUris(
+        {f"{service_name}{uri.path}": MessageToDict(uri) for uri in uris},
+        True,
+        time.monotonic(),
+    )
+
+
+async def _refresh_uris() -> None:
+    global uris_refreshed
+    await asyncio.gather(
+        *(_query_uris(service_name, client) for service_name, client in clients.items())
+    )
+    uris_refreshed = time.monotonic()
+
+
+async def _cached_uris() -> dict[str, ServiceUris]:
+    global uris_refresh
+    if time.monotonic() - uris_refreshed > URIS_TTL and (
+        uris_refresh is None or uris_refresh.done()
+    ):
+        uris_refresh = asyncio.create_task(_refresh_uris())
+    if not uris_refreshed:
+        # nothing cached yet, wait for the first query
+        await asyncio.shield(uris_refresh)
+    return service_uris
+
+
 @app.get("/list_uris")
 async def list_uris() -> JSONResponse:
     """Coroutine to list all the uris from all the event services
 
+    The services are queried concurrently and the answers cached for URIS_TTL
+    seconds. Requests after that get the cached uris while they are refreshed in
+    the background, so they never wait for services which are down.
+
     Returns:
         JSONResponse: the list of uris as a json.
 
@@ -74,22 +166,35 @@ async def list_uris() -> JSONResponse:
         curl -X GET "http://localhost:8042/list_uris"
     """
     all_uris = {}
+    for uris in (await _cached_uris()).values():
+        if uris.reachable:
+            all_uris.update(uris.uris)
 
-    for service_name, client in clients.items():
-        # get the list of uris from the event service
-        uris: list[Uri] = []
-        try:
-            # NOTE: some services may not be available, so we need to handle the timeout
-            uris = await asyncio.wait_for(client.list_uris(), timeout=0.1)
-        except asyncio.TimeoutError:
-            continue
+    return JSONResponse(content=all_uris, status_code=200)
 
-        # convert the uris to a dict, where the key is the uri full path
-        # and the value is the uri proto as a json string
-        for uri in uris:
-            all_uris[f"{service_name}{uri.path}"] = json.loads(MessageToJson(uri))
 
-    return JSONResponse(content=all_uris, status_code=200)
+@app.get("/services")
+async def services() -> JSONResponse:
+    """Coroutine to list the event services, whether they are reachable and the age
+    of their cached uris.
+
+    Returns:
+        JSONResponse: the reachable flag, number of uris and age in seconds (null if
+            never reached) per service.
+
+    Usage:
+        curl -X GET "http://localhost:8042/services"
+    """
+    now = time.monotonic()
+    content = {
+        service_name: {
+            "reachable": uris.reachable,
+            "num_uris": len(uris.uris),
+            "age_seconds": now - uris.updated if uris.updated else None,
+        }
+        for service_name, uris in (await _cached_uris()).items()
+    }
+    return JSONResponse(content=content, status_code=200)
 
 
 # @app.post("/start_lidar")
@@ -103,61 +208,697 @@ async def list_uris() -> JSONResponse:
 #     await client._event_client.request_reply("/start_scan", Empty())
 
 
-@app.websocket("/subscribe/{service_name}/{uri_path}")
+# to store the shared upstream subscriptions,
+# keyed by (service, uri, every_n, format, reduction)
+broadcasters: dict[tuple, Broadcaster] = {}
+
+
+def _is_lidar_data(service_name: str, uri_path: str) -> bool:
+    # the scans of a lidar, or with several lidars of one of them (data/<name>)
+    return service_name == "lidar" and uri_path.split("/")[0] == "data"
+
+
+# the pending /start_scan requests, referenced until they are done
+start_scan_requests: set[asyncio.Task] = set()
+
+
+async def _start_scan(client: EventClient, uri_path: str) -> None:
+    logger.debug("Requesting /start_scan for %s", uri_path)
+    try:
+        await client.request_reply("/start_scan", Empty())
+    except Exception as error:
+        logger.warning("/start_scan for %s failed: %r", uri_path, error)
+
+
+def _create_broadcaster(
+    service_name: str,
+    uri_path: str,
+    every_n: int,
+    format: str,
+    reduction: PointReduction,
+) -> Broadcaster:
+    client: EventClient = clients[service_name]
+    is_lidar_data = _is_lidar_data(service_name, uri_path)
+    start_time = datetime.now()
+    # shared by the viewers, each new one gets a keyframe
+    delta_encoder = DeltaFrameEncoder()
+    num_viewers = 0
+
+    async def messages():
+        async for _, message in client.subscribe(
+            request=SubscribeRequest(uri=Uri(path=f"/{uri_path}"), every_n=every_n),
+            decode=True,
+        ):
+            if is_lidar_data and metrics.enabled:
+                metrics.scan(
+                    (uri_path, message.header.seq),
+                    "receive",
+                    scan_timestamp_ns(message.header),
+                )
+            yield message
+
+    def encode_scan(message):
+        if format in ("protobuf", "msgpack"):
+            return encode_message(message, format)
+
+        # the sweep time as z, except for the lidar's own z (merging in 3D)
+        start = metrics.clock()
+        x_values, y_values, z_values = pySickScanCartesianPointCloudMsgToXYZ(
+            message, None if format == "xyz" else start_time
+        )
+        if reduction.enabled:
+            x_values, y_values, z_values = reduction.apply(x_values, y_values, z_values)
+        metrics.stage("to_xyz", start)
+
+        if format in ("points", "xyz"):
+            # internal, for the scan accumulator and the merged lidars
+            return message.header, x_values, y_values, z_values
+        if format == "binary":
+            return encode_points_frame(
+                message.header, {"x": x_values, "y": y_values, "z": z_values}
+            )
+        if format == "delta":
+            nonlocal num_viewers
+            if broadcaster.num_viewers > num_viewers:
+                delta_encoder.request_keyframe()
+            num_viewers = broadcaster.num_viewers
+            return delta_encoder.encode(
+                message.header, {"x": x_values, "y": y_values, "z": z_values}
+            )
+        return dumps_json({"x": x_values, "y": y_values, "z": z_values})
+
+    def encode(message):
+        if not is_lidar_data:
+            return encode_message(message, format)
+        if not metrics.enabled or format in ("points", "xyz"):
+            return encode_scan(message)
+
+        start = metrics.clock()
+        frame = encode_scan(message)
+        metrics.stage(f"encode_{format}", start)
+        # the websocket sends are recorded against the scan's seq
+        return TracedFrame(frame, (uri_path, message.header.seq))
+
+    def on_close(broadcaster: Broadcaster) -> None:
+        if broadcasters.get(broadcaster.key) is broadcaster:
+            del broadcasters[broadcaster.key]
+
+    def on_attach(broadcaster: Broadcaster) -> None:
+        # captures stop after --scan-duration, so every subscriber starts one,
+        # which the lidar service ignores while it is capturing
+        if is_lidar_data:
+            task = asyncio.create_task(_start_scan(client, uri_path))
+            start_scan_requests.add(task)
+            task.add_done_callback(start_scan_requests.discard)
+
+    key = (service_name, uri_path, every_n, format, reduction)
+    broadcaster = Broadcaster(key, messages, encode, on_close, on_attach)
+    return broadcaster
+
+
+def _get_broadcaster(key: tuple) -> Broadcaster:
+    if key not in broadcasters:
+        broadcasters[key] = _create_broadcaster(*key)
+    return broadcasters[key]
+
+
+async def _wait_for_disconnect(websocket: WebSocket) -> None:
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
+
+async def _send_frame(websocket: WebSocket, frame) -> None:
+    if isinstance(frame, bytes):
+        await websocket.send_bytes(frame)
+    else:
+        await websocket.send_text(frame)
+
+
+async def _send_frames(websocket: WebSocket, queue: SendQueue) -> None:
+    while True:
+        frame = await queue.get()
+        if frame is None:
+            # the upstream subscription has ended
+            await websocket.close()
+            return
+        if isinstance(frame, TracedFrame):
+            start = metrics.clock()
+            await _send_frame(websocket, frame.frame)
+            metrics.stage("websocket_send", start)
+            metrics.scan(frame.key, "websocket_send")
+        else:
+            await _send_frame(websocket, frame)
+
+
+async def _stream_to_viewer(
+    websocket: WebSocket,
+    broadcaster: Broadcaster,
+    queue_size: int,
+    overflow: OverflowPolicy,
+) -> None:
+    # send the frames of the broadcaster until either side closes
+    queue = broadcaster.attach(queue_size, overflow)
+    sender = asyncio.create_task(_send_frames(websocket, queue))
+    receiver = asyncio.create_task(_wait_for_disconnect(websocket))
+    try:
+        done, pending = await asyncio.wait(
+            {sender, receiver}, return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if task.exception() is not None and not isinstance(
+                task.exception(), WebSocketDisconnect
+            ):
+                logger.warning(
+                    "WebSocket %s failed: %r", broadcaster.key, task.exception()
+                )
+    finally:
+        sender.cancel()
+        receiver.cancel()
+        broadcaster.detach(queue)
+        logger.info(
+            "WebSocket disconnected, dropped %d of %d frames",
+            queue.frames_dropped,
+            queue.frames_queued,
+        )
+
+
+@app.get("/metrics")
+async def latency_metrics() -> Response:
+    """Coroutine to return the latency histograms of the lidar scans, see latency.py.
+
+    They are only recorded with --metrics, stages of the lidar service are served
+    by the service itself (its --metrics-port).
+
+    Returns:
+        Response: the histograms in the Prometheus text format.
+
+    Usage:
+        curl -X GET "http://localhost:8042/metrics"
+    """
+    return Response(content=metrics.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/subscriptions")
+async def subscriptions() -> JSONResponse:
+    """Coroutine to list the active websocket subscriptions and their queue stats.
+
+    Returns:
+        JSONResponse: the viewers and dropped frame counters per subscription.
+
+    Usage:
+        curl -X GET "http://localhost:8042/subscriptions"
+    """
+    content = {
+        "/".join(str(part) for part in key): broadcaster.stats()
+        for key, broadcaster in broadcasters.items()
+    }
+    return JSONResponse(content=content, status_code=200)
+
+
+@app.websocket("/subscribe/{service_name}/{uri_path:path}")
 async def subscribe(
-    websocket: WebSocket, service_name: str, uri_path: str, every_n: int = 1
+    websocket: WebSocket,
+    service_name: str,
+    uri_path: str,
+    every_n: int = 1,
+    format: str = "json",
+    queue_size: int = 4,
+    overflow: str = "drop_oldest",
+    stride: int = 1,
+    min_range: float = 0.0,
+    max_range: float = 0.0,
+    voxel: float = 0.0,
 ):
     """Coroutine to subscribe to an event service via websocket.
 
+    Viewers of the same (service_name, uri_path, every_n, format) and lidar point
+    reduction share a single upstream subscription, so each message is received,
+    converted and reduced only once.
+    Each viewer has its own bounded send queue, so a slow browser does not hold
+    up the subscription (unless overflow="block").
+
     Args:
         websocket (WebSocket): the websocket connection
         service_name (str): the name of the event service
-        uri_path (str): the uri path to subscribe to
+        uri_path (str): the uri path to subscribe to, e.g. data or data/102
         every_n (int, optional): the frequency to receive events. Defaults to 1.
+        format (str, optional): "json", "protobuf" or "msgpack" (see
+            topic_encoders.py), or "binary" to stream lidar scans as binary frames
+            (see frames.py), or "delta" for keyframes with int16 delta frames in
+            between, about half the bytes. Defaults to "json".
+        queue_size (int, optional): the number of frames buffered for this viewer.
+            Defaults to 4.
+        overflow (str, optional): what to do when the send queue is full, one of
+            "drop_oldest", "latest" (only keep the newest frame) or "block".
+            Defaults to "drop_oldest".
+        stride (int, optional): lidar only, keep every stride-th point. Defaults to 1.
+        min_range (float, optional): lidar only, drop points closer than this (m).
+            Defaults to 0.0.
+        max_range (float, optional): lidar only, drop points further than this (m),
+            0 for no limit. Defaults to 0.0.
+        voxel (float, optional): lidar only, voxel-grid downsample with voxels of
+            this size (m), 0 to disable. Defaults to 0.0.
 
     Usage:
         ws = new WebSocket("ws://localhost:8042/subscribe/oak0/left
+        ws = new WebSocket("ws://localhost:8042/subscribe/lidar/data?format=binary
+        ws = new WebSocket("ws://localhost:8042/subscribe/lidar/data?format=delta
+        ws = new WebSocket("ws://localhost:8042/subscribe/lidar/data?overflow=latest
+        ws = new WebSocket("ws://localhost:8042/subscribe/lidar/data?stride=2&voxel=0.05
     """
-
-    client: EventClient = clients[service_name]
+    if (
+        service_name not in clients
+        or overflow not in set(OverflowPolicy)
+        or format not in TOPIC_FORMATS + ("binary", "delta")
+        # only lidar scans can be sent as binary frames
+        or (
+            format in ("binary", "delta") and not _is_lidar_data(service_name, uri_path)
+        )
+    ):
+        await websocket.close(code=1008)
+        return
 
     await websocket.accept()
 
-    if service_name == "lidar" and uri_path == "data":
-        start_time = datetime.now()
-        print("requesting start_scan reply", flush=True)
-        await client.request_reply("/start_scan", Empty())
-        print("continuing", flush=True)
+    reduction = PointReduction(max(1, stride), min_range, max_range, voxel)
+    key = (service_name, uri_path, every_n, format, reduction)
+    await _stream_to_viewer(
+        websocket, _get_broadcaster(key), queue_size, OverflowPolicy(overflow)
+    )
 
-    try:
 
-        async for _, message in client.subscribe(
-            request=SubscribeRequest(uri=Uri(path=f"/{uri_path}"), every_n=every_n),
-            decode=True,
-        ):
-            # print(f"Received message.")
+# the rolling map of the recent lidar scans, fed while it is in use
+accumulator: ScanAccumulator | None = None
+accumulator_task: asyncio.Task | None = None
+map_window_seconds = WINDOW_SECONDS
+map_max_points = MAX_POINTS
 
-            if service_name == "lidar" and uri_path == "data":
 
-                x_values, y_values, z_values = pySickScanCartesianPointCloudMsgToXYZ(
-                    message, start_time
+async def _accumulate_lidar(
+    scans: ScanAccumulator, uri_path: str, matrix: np.ndarray | None
+) -> None:
+    broadcaster = _get_broadcaster(("lidar", uri_path, 1, "points", PointReduction()))
+    queue = broadcaster.attach(64, OverflowPolicy.DROP_OLDEST)
+    try:
+        while True:
+            frame = await queue.get()
+            if frame is None:
+                break
+            header, x_values, y_values, z_values = frame
+            if matrix is not None:
+                # into the rig frame in the scan plane, z is the sweep time
+                x_values, y_values, _ = transform_points(
+                    matrix, x_values, y_values, np.zeros_like(x_values)
                 )
+            scans.add(x_values, y_values, z_values, scan_timestamp_ns(header))
+    finally:
+        broadcaster.detach(queue)
+        if queue.frames_dropped:
+            logger.warning("Map dropped %d scans of %s", queue.frames_dropped, uri_path)
+
 
-                obj = {
-                    "x": [float(x) for x in x_values],
-                    "y": [float(y) for y in y_values],
-                    "z": [float(z) for z in z_values],
-                }
-                await websocket.send_json(obj)
+async def _accumulate(scans: ScanAccumulator) -> None:
+    # with several lidars the map holds the scans of all of them
+    names = await _lidar_names()
+    sources = {f"data/{name}": extrinsics.get(name) for name in names} or {"data": None}
+    try:
+        await asyncio.gather(
+            *(
+                _accumulate_lidar(scans, uri_path, matrix)
+                for uri_path, matrix in sources.items()
+            )
+        )
+    finally:
+        scans.close()
+
+
+def _get_accumulator() -> ScanAccumulator:
+    global accumulator, accumulator_task
+    if accumulator is None or accumulator.closed:
+        accumulator = ScanAccumulator(map_window_seconds, map_max_points)
+        accumulator_task = asyncio.create_task(_accumulate(accumulator))
+    return accumulator
+
+
+def _encode_map(scans: ScanAccumulator, cursor, x_values, y_values, z_values, format):
+    if format == "binary":
+        header = FrameHeader.from_ns(cursor, scans.newest_ns)
+        return encode_points_frame(
+            header, {"x": x_values, "y": y_values, "z": z_values}
+        )
+    return dumps_json({"cursor": cursor, "x": x_values, "y": y_values, "z": z_values})
+
+
+@app.get("/map")
+async def map_snapshot(
+    format: str = "json",
+    stride: int = 1,
+    min_range: float = 0.0,
+    max_range: float = 0.0,
+    voxel: float = 0.0,
+) -> Response:
+    """Coroutine to get the points of the lidar scans of the last few seconds.
+
+    The first request starts accumulating the scans (and a lidar sweep), so it may
+    return an empty map. The accumulation keeps running until /map/stop. With
+    several lidars the map holds the scans of all of them, moved into the rig
+    frame with their --extrinsics.
+
+    Args:
+        format (str, optional): "json" or "binary" (a frame as in frames.py, whose
+            seq is the cursor). Defaults to "json".
+        stride, min_range, max_range, voxel: reduce the map, as for /subscribe,
+            but the voxels only divide x and y.
+
+    Returns:
+        Response: the x, y and z (sweep time offset) values of the points and the
+            cursor of the map.
+
+    Usage:
+        curl -X GET "http://localhost:8042/map?voxel=0.1"
+    """
+    if format not in ("json", "binary"):
+        return JSONResponse(content={"error": "unknown format"}, status_code=400)
+
+    scans = _get_accumulator()
+    x_values, y_values, z_values = scans.snapshot()
+    reduction = PointReduction(max(1, stride), min_range, max_range, voxel)
+    if reduction.enabled:
+        # z is the sweep time, so points of different scans share x/y voxels
+        x_values, y_values, z_values = reduction.apply(
+            x_values, y_values, z_values, planar=True
+        )
+
+    content = _encode_map(scans, scans.cursor, x_values, y_values, z_values, format)
+    if format == "binary":
+        return Response(content=content, media_type="application/octet-stream")
+    return Response(content=content, media_type="application/json")
+
+
+@app.post("/map/stop")
+async def map_stop() -> JSONResponse:
+    """Coroutine to stop accumulating the lidar scans and free the map.
+
+    Usage:
+        curl -X POST "http://localhost:8042/map/stop"
+    """
+    global accumulator, accumulator_task
+    if accumulator_task is not None:
+        accumulator_task.cancel()
+    accumulator = accumulator_task = None
+    return JSONResponse(content={}, status_code=200)
+
+
+async def _send_map(
+    websocket: WebSocket, scans: ScanAccumulator, format: str, snapshot: bool
+) -> None:
+    cursor = scans.cursor
+    if snapshot:
+        await _send_frame(
+            websocket, _encode_map(scans, cursor, *scans.snapshot(), format)
+        )
+
+    while True:
+        await scans.wait(cursor)
+        if scans.closed:
+            await websocket.close()
+            return
+        x_values, y_values, z_values, cursor = scans.since(cursor)
+        await _send_frame(
+            websocket, _encode_map(scans, cursor, x_values, y_values, z_values, format)
+        )
+
+
+@app.websocket("/map/subscribe")
+async def map_subscribe(
+    websocket: WebSocket, format: str = "json", snapshot: bool = True
+):
+    """Coroutine to stream the rolling map of the lidar scans via websocket.
+
+    Sends the current map, then only the points added since the previous frame.
+    The viewer appends them and drops the points older than the map window (or
+    fetches a fresh /map now and then).
+
+    Args:
+        websocket (WebSocket): the websocket connection
+        format (str, optional): "json" or "binary". Defaults to "json".
+        snapshot (bool, optional): start with the whole current map. Defaults to True.
+
+    Usage:
+        ws = new WebSocket("ws://localhost:8042/map/subscribe?format=binary
+    """
+    if "lidar" not in clients or format not in ("json", "binary"):
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+
+    sender = asyncio.create_task(
+        _send_map(websocket, _get_accumulator(), format, snapshot)
+    )
+    receiver = asyncio.create_task(_wait_for_disconnect(websocket))
+    try:
+        await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        sender.cancel()
+        receiver.cancel()
+
+
+# where lidar_service.py records the sweeps
+recordings_directory = "/mnt/managed_home/farm-ng-user-gsainsbury"
+
+
+@app.get("/export/{sweep_name:path}")
+async def export_sweep(
+    sweep_name: str,
+    format: str = "ply",
+    z: str = "index",
+    start_time: Optional[int] = None,
+    end_time: Optional[int] = None,
+) -> Response:
+    """Coroutine to download a recorded sweep as a PLY or LAS point cloud, or as a
+    Parquet or Arrow table of the points with all their fields (see columnar.py).
+
+    The file is streamed one chunk of scans at a time from the recording, so large
+    sweeps are never held in memory. Sweeps still being recorded are exported up to
+    the scans written when the request arrived.
+
+    Args:
+        sweep_name (str): the recording directory, e.g. lidar_2024_05_01_12_00_00,
+            or lidar_2024_05_01_12_00_00/102 for one of several lidars (the root
+            of such a capture is rejected with the list of its sweeps)
+        format (str, optional): "ply", "las", or with pyarrow installed "parquet"
+            or "arrow". Defaults to "ply".
+        z (str, optional): the z axis of the point clouds, "index" (scan index /
+            100), "time" (seconds since the first scan) or "sensor". Defaults to
+            "index".
+        start_time (int, optional): only export scans from this time (ns since epoch).
+        end_time (int, optional): only export scans before this time (ns since epoch).
+
+    Usage:
+        curl -o sweep.ply "http://localhost:8042/export/lidar_2024_05_01_12_00_00"
+        curl -o sweep.parquet "http://localhost:8042/export/lidar_2024_05_01_12_00_00?format=parquet"
+    """
+    sweep_name = os.path.normpath(sweep_name)
+    directory = os.path.join(recordings_directory, sweep_name)
+    if (
+        sweep_name.startswith("..")
+        or os.path.isabs(sweep_name)
+        or not os.path.isdir(directory)
+        or format not in EXPORT_FORMATS + COLUMNAR_FORMATS
+        or z not in Z_AXES
+    ):
+        return JSONResponse(
+            content={"error": "unknown sweep or format"}, status_code=404
+        )
+    if not is_scan_log(directory) and lidar_directories(directory):
+        return JSONResponse(
+            content={
+                "error": "a capture of several lidars, export one of them",
+                "sweeps": [
+                    os.path.join(sweep_name, name)
+                    for name in lidar_directories(directory)
+                ],
+            },
+            status_code=400,
+        )
+
+    reader = SweepReader(directory)
+    scan_range = {"start_time": start_time, "end_time": end_time}
+    summary = None
+    try:
+        if format in EXPORT_FORMATS:
+            # the first pass over the sweep, for the point count in the file header
+            loop = asyncio.get_running_loop()
+            summary = await loop.run_in_executor(
+                None, lambda: summarize(reader, z, **scan_range)
+            )
+    except BaseException:
+        # otherwise the reader is closed by chunks()
+        reader.close()
+        raise
+
+    def chunks():
+        with reader:
+            if format in COLUMNAR_FORMATS:
+                yield from export_columnar(reader, format, **scan_range)
             else:
-                await websocket.send_json(MessageToJson(message))
+                yield from export_chunks(reader, format, z, summary, **scan_range)
+
+    return StreamingResponse(
+        chunks(),
+        media_type="application/octet-stream",
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="{sweep_name.replace(os.sep, "_")}.{format}"'
+            )
+        },
+    )
 
-        await websocket.close()
-    except WebSocketDisconnect:
-        print("WebSocket disconnected remotely")
 
-        print("finished")
-        # print(lidar_buffer)
+# the 4x4 transforms of the lidars into the rig frame, keyed by name (see merge.py)
+extrinsics: dict = {}
+
+
+async def _lidar_names() -> list[str]:
+    # the lidars publishing on data/<name>, from the cached uris of the lidar service
+    uris = (await _cached_uris()).get("lidar")
+    return sorted(
+        path[len("lidar/data/") :]
+        for path in (uris.uris if uris is not None else {})
+        if path.startswith("lidar/data/")
+    )
+
+
+def _create_merged_broadcaster(
+    names: tuple, format: str, reduction: PointReduction, tolerance_ns: int
+) -> Broadcaster:
+    async def messages():
+        merger = ScanMerger(list(names), extrinsics, tolerance_ns)
+        sources = {
+            name: _get_broadcaster(
+                ("lidar", f"data/{name}", 1, "xyz", PointReduction())
+            )
+            for name in names
+        }
+        queues = {
+            name: source.attach(16, OverflowPolicy.DROP_OLDEST)
+            for name, source in sources.items()
+        }
+        scans: asyncio.Queue = asyncio.Queue(maxsize=len(names))
+
+        async def forward(name: str, queue: SendQueue) -> None:
+            while True:
+                frame = await queue.get()
+                await scans.put((name, frame))
+                if frame is None:
+                    return
+
+        tasks = [asyncio.create_task(forward(*item)) for item in queues.items()]
+        try:
+            while True:
+                name, frame = await scans.get()
+                if frame is None:
+                    # the subscription of one of the lidars has ended
+                    return
+                header, x_values, y_values, z_values = frame
+                for merged in merger.push(
+                    name, scan_timestamp_ns(header), x_values, y_values, z_values
+                ):
+                    yield merged
+        finally:
+            for task in tasks:
+                task.cancel()
+            for name, queue in queues.items():
+                sources[name].detach(queue)
+
+    seq = itertools.count()
+
+    def encode(merged: MergedScan):
+        x_values, y_values, z_values = merged.x, merged.y, merged.z
+        if reduction.enabled:
+            x_values, y_values, z_values = reduction.apply(x_values, y_values, z_values)
+        if format == "binary":
+            header = FrameHeader.from_ns(next(seq), merged.timestamp_ns)
+            return encode_points_frame(
+                header, {"x": x_values, "y": y_values, "z": z_values}
+            )
+        return dumps_json(
+            {
+                "timestamp_ns": merged.timestamp_ns,
+                "skew_ns": merged.skew_ns,
+                "x": x_values,
+                "y": y_values,
+                "z": z_values,
+            }
+        )
+
+    def on_close(broadcaster: Broadcaster) -> None:
+        if broadcasters.get(broadcaster.key) is broadcaster:
+            del broadcasters[broadcaster.key]
+
+    key = ("lidar", "merged", names, format, reduction, tolerance_ns)
+    return Broadcaster(key, messages, encode, on_close)
+
+
+@app.websocket("/merged")
+async def merged(
+    websocket: WebSocket,
+    lidars: str = "",
+    format: str = "json",
+    tolerance_ms: float = TOLERANCE_NS / 1e6,
+    queue_size: int = 4,
+    overflow: str = "drop_oldest",
+    stride: int = 1,
+    min_range: float = 0.0,
+    max_range: float = 0.0,
+    voxel: float = 0.0,
+):
+    """Coroutine to stream the scans of several lidars fused into one point cloud.
+
+    The scans of the lidars nearest in time (within tolerance_ms) are merged and
+    their points moved to the rig frame with the --extrinsics transforms, see
+    merge.py. z is the height in the rig frame, not the sweep time.
+
+    Args:
+        websocket (WebSocket): the websocket connection
+        lidars (str, optional): the comma separated names of the lidars to merge.
+            Defaults to all the lidars publishing on lidar/data/<name>, other
+            names are rejected.
+        format (str, optional): "json" or "binary". Defaults to "json".
+        tolerance_ms (float, optional): the largest time difference between the
+            merged scans. Defaults to 2 ms.
+        queue_size, overflow, stride, min_range, max_range, voxel: as for /subscribe.
+
+    Usage:
+        ws = new WebSocket("ws://localhost:8042/merged?lidars=102,103&format=binary
+    """
+    available = await _lidar_names()
+    names = tuple(lidars.split(",")) if lidars else tuple(available)
+    if (
+        "lidar" not in clients
+        or not names
+        # the scans of an unknown lidar would never arrive
+        or not set(names).issubset(available)
+        or overflow not in set(OverflowPolicy)
+        or format not in ("json", "binary")
+    ):
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+
+    reduction = PointReduction(max(1, stride), min_range, max_range, voxel)
+    key = ("lidar", "merged", names, format, reduction, int(tolerance_ms * 1e6))
+    if key not in broadcasters:
+        broadcasters[key] = _create_merged_broadcaster(*key[2:])
+    await _stream_to_viewer(
+        websocket, broadcasters[key], queue_size, OverflowPolicy(overflow)
+    )
 
 
 if __name__ == "__main__":
@@ -165,7 +906,42 @@ if __name__ == "__main__":
     parser.add_argument("--config", type=Path, required=True, help="config file")
     parser.add_argument("--port", type=int, default=8042, help="port to run the server")
     parser.add_argument("--debug", action="store_true", help="debug mode")
+    parser.add_argument(
+        "--map-window",
+        type=float,
+        default=WINDOW_SECONDS,
+        help="seconds of lidar scans kept in the /map",
+    )
+    parser.add_argument(
+        "--map-max-points",
+        type=int,
+        default=MAX_POINTS,
+        help="capacity of the /map point buffer",
+    )
+    parser.add_argument(
+        "--recordings-dir",
+        type=str,
+        default=recordings_directory,
+        help="the directory of the lidar_<date> recordings served by /export",
+    )
+    parser.add_argument(
+        "--extrinsics",
+        type=str,
+        default=None,
+        help="the JSON file of the lidar 4x4 transforms used by /merged",
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="record the latency of each stage of the lidar scans, served on /metrics",
+    )
     args = parser.parse_args()
+    metrics.enable(args.metrics)
+    if args.extrinsics:
+        extrinsics = load_extrinsics(args.extrinsics)
+    recordings_directory = args.recordings_dir
+    map_window_seconds = args.map_window
+    map_max_points = args.map_max_points
 
     # NOTE: we only serve the react app in debug mode
     if not args.debug:
@@ -0,0 +1,237 @@
+"""Fuse the scans of several lidars into one point cloud, matched by timestamp.
+
+The lidars are not triggered together, so the scans of one are paired with the
+scans of the others nearest in time, within a tolerance covering the jitter
+between their clocks. Each lidar's points are moved into the common (rig) frame
+with its static 4x4 extrinsic transform.
+
+Extrinsics are a JSON object of row-major 4x4 matrices keyed by lidar name:
+
+    {"102": [[1, 0, 0, 0], [0, 1, 0, 0.5], [0, 0, 1, 0], [0, 0, 0, 1]], ...}
+
+Lidars without an entry use the identity.
+
+Usage:
+    python merge.py /path/to/lidar_<date> fused.ply --extrinsics extrinsics.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import heapq
+import json
+import os
+from collections import deque
+from typing import Iterator, NamedTuple
+
+import numpy as np
+
+from pointcloud import pySickScanCartesianPointCloudMsgToXYZ
+from scan_log import scan_timestamp_ns
+from sweep_reader import SweepReader
+
+# the largest timestamp difference between scans merged together
+TOLERANCE_NS = 2_000_000
+# scans kept per lidar while waiting for the others
+MAX_PENDING = 16
+
+
+def load_extrinsics(path: str) -> dict[str, np.ndarray]:
+    """Load the 4x4 extrinsic transforms of the lidars from a JSON file."""
+    with open(path) as extrinsics_file:
+        matrices = json.load(extrinsics_file)
+    extrinsics = {}
+    for name, matrix in matrices.items():
+        extrinsics[name] = np.asarray(matrix, dtype=np.float64)
+        assert extrinsics[name].shape == (4, 4), f"{name}: not a 4x4 matrix"
+    return extrinsics
+
+
+def transform_points(matrix: np.ndarray, x, y, z):
+    """Apply a 4x4 rigid transform to the points, returning float32 x, y and z."""
+    xyz = np.column_stack((x, y, z)).astype(np.float64)
+    xyz = xyz @ matrix[:3, :3].T + matrix[:3, 3]
+    xyz = xyz.astype(np.float32)
+    return xyz[:, 0], xyz[:, 1], xyz[:, 2]
+
+
+class TimedScan(NamedTuple):
+    timestamp_ns: int
+    x: np.ndarray
+    y: np.ndarray
+    z: np.ndarray
+
+
+class MergedScan(NamedTuple):
+    """The points of one scan of each lidar, in the rig frame."""
+
+    timestamp_ns: int  # of the newest of the merged scans
+    skew_ns: int  # between the oldest and the newest of the merged scans
+    x: np.ndarray
+    y: np.ndarray
+    z: np.ndarray
+
+
+class ScanMerger:
+    """Pair the scans of several lidars nearest in time and fuse their points.
+
+    Scans are pushed as they arrive, in timestamp order per lidar. A merge is
+    emitted once every lidar has a scan within tolerance_ns of the newest of the
+    oldest pending scans, choosing for each lidar the scan nearest to it. Scans
+    which can no longer be matched are dropped.
+    """
+
+    def __init__(
+        self,
+        names: list[str],
+        extrinsics: dict[str, np.ndarray] | None = None,
+        tolerance_ns: int = TOLERANCE_NS,
+        max_pending: int = MAX_PENDING,
+    ) -> None:
+        self.names = list(names)
+        self.tolerance_ns = tolerance_ns
+        self._extrinsics = extrinsics or {}
+        self._pending = {name: deque(maxlen=max_pending) for name in self.names}
+        self.scans_merged = 0
+        self.scans_dropped = 0
+
+    def push(self, name: str, timestamp_ns: int, x, y, z) -> list[MergedScan]:
+        """Add a scan of lidar name, returning the merges it completes."""
+        if name in self._extrinsics:
+            x, y, z = transform_points(self._extrinsics[name], x, y, z)
+        pending = self._pending[name]
+        if len(pending) == pending.maxlen:
+            self.scans_dropped += 1
+        pending.append(TimedScan(timestamp_ns, x, y, z))
+        return self._merge()
+
+    def flush(self) -> list[MergedScan]:
+        """Merge what can still be merged once no more scans will be pushed."""
+        return self._merge(final=True)
+
+    def _merge(self, final: bool = False) -> list[MergedScan]:
+        merged = []
+        queues = list(self._pending.values())
+        while all(queues):
+            pivot = max(queue[0].timestamp_ns for queue in queues)
+
+            stale = False
+            for queue in queues:
+                while queue and queue[0].timestamp_ns < pivot - self.tolerance_ns:
+                    queue.popleft()
+                    self.scans_dropped += 1
+                    stale = True
+            if stale:
+                continue
+
+            # wait until each lidar has a scan at or after the pivot, so that a
+            # later scan nearer to it is not missed
+            if not final and any(queue[-1].timestamp_ns < pivot for queue in queues):
+                break
+
+            scans = []
+            for queue in queues:
+                nearest = min(
+                    range(len(queue)),
+                    key=lambda i: abs(queue[i].timestamp_ns - pivot),
+                )
+                for _ in range(nearest):
+                    queue.popleft()
+                    self.scans_dropped += 1
+                scans.append(queue.popleft())
+
+            timestamps = [scan.timestamp_ns for scan in scans]
+            merged.append(
+                MergedScan(
+                    max(timestamps),
+                    max(timestamps) - min(timestamps),
+                    np.concatenate([scan.x for scan in scans]),
+                    np.concatenate([scan.y for scan in scans]),
+                    np.concatenate([scan.z for scan in scans]),
+                )
+            )
+            self.scans_merged += len(scans)
+        return merged
+
+
+def lidar_directories(sweep: str) -> dict[str, str]:
+    """The recording of each lidar of a capture of several lidars, keyed by name."""
+    return {
+        name: os.path.join(sweep, name)
+        for name in sorted(os.listdir(sweep))
+        if os.path.isdir(os.path.join(sweep, name))
+    }
+
+
+def _timed_scans(name: str, reader: SweepReader):
+    for scan in reader.scans():
+        yield scan_timestamp_ns(scan.header), name, scan
+
+
+def merge_recordings(
+    directories: dict[str, str],
+    extrinsics: dict[str, np.ndarray] | None = None,
+    tolerance_ns: int = TOLERANCE_NS,
+) -> Iterator[MergedScan]:
+    """Merge recorded sweeps of several lidars, streaming them in timestamp order."""
+    readers = {name: SweepReader(directory) for name, directory in directories.items()}
+    merger = ScanMerger(list(readers), extrinsics, tolerance_ns)
+    try:
+        for timestamp_ns, name, scan in heapq.merge(
+            *(_timed_scans(name, reader) for name, reader in readers.items()),
+            key=lambda timed: timed[0],
+        ):
+            x, y, z = pySickScanCartesianPointCloudMsgToXYZ(scan)
+            yield from merger.push(name, timestamp_ns, x, y, z)
+        yield from merger.flush()
+    finally:
+        for reader in readers.values():
+            reader.close()
+
+
+if __name__ == "__main__":
+    from export import SweepSummary, ply_header
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("sweep", help="the capture directory, with one per lidar")
+    parser.add_argument("output", help="the .ply file to write")
+    parser.add_argument("--extrinsics", help="the JSON file of the 4x4 transforms")
+    parser.add_argument(
+        "--tolerance-ms",
+        type=float,
+        default=TOLERANCE_NS / 1e6,
+        help="the largest time difference between merged scans",
+    )
+    parser.add_argument(
+        "--sweep-step",
+        type=float,
+        default=0.0,
+        help="offset each merged scan by this much (m) more than the previous one "
+        "along --sweep-axis, e.g. 0.01 as in reconstruct_lidar.py",
+    )
+    parser.add_argument(
+        "--sweep-axis", choices=("x", "y", "z"), default="z", help="the sweep axis"
+    )
+    args = parser.parse_args()
+
+    directories = lidar_directories(args.sweep)
+    extrinsics = load_extrinsics(args.extrinsics) if args.extrinsics else None
+    tolerance_ns = int(args.tolerance_ms * 1e6)
+
+    # count the points first, the PLY header needs the number of points
+    num_points = sum(
+        len(merged.x)
+        for merged in merge_recordings(directories, extrinsics, tolerance_ns)
+    )
+    summary = SweepSummary(num_points, False, np.zeros(3), np.zeros(3))
+
+    with open(args.output, "wb") as output:
+        output.write(ply_header(summary))
+        axis = "xyz".index(args.sweep_axis)
+        for i, merged in enumerate(
+            merge_recordings(directories, extrinsics, tolerance_ns)
+        ):
+            xyz = np.column_stack((merged.x, merged.y, merged.z)).astype("<f4")
+            xyz[:, axis] += i * args.sweep_step
+            output.write(xyz.tobytes())
+    print(args.output, flush=True)
@@ -0,0 +1,124 @@
+"""Decode SickScanPointCloudMsg point data with numpy.
+
+Works on both the ctypes SickScanPointCloudMsg of the live driver and
+lidar_pb2.SickScanPointCloudMsg, and only needs numpy: the sick_scan library is
+never loaded, so offline tools can run on machines without the SICK driver.
+"""
+
+import ctypes
+import datetime
+import functools
+
+import numpy as np
+
+# numpy type codes for SickScanNativeDataType (equivalent to ros::sensor_msgs::PointField types)
+POINTFIELD_DATATYPES = {
+    1: "i1",  # SICK_SCAN_POINTFIELD_DATATYPE_INT8
+    2: "u1",  # SICK_SCAN_POINTFIELD_DATATYPE_UINT8
+    3: "i2",  # SICK_SCAN_POINTFIELD_DATATYPE_INT16
+    4: "u2",  # SICK_SCAN_POINTFIELD_DATATYPE_UINT16
+    5: "i4",  # SICK_SCAN_POINTFIELD_DATATYPE_INT32
+    6: "u4",  # SICK_SCAN_POINTFIELD_DATATYPE_UINT32
+    7: "f4",  # SICK_SCAN_POINTFIELD_DATATYPE_FLOAT32
+    8: "f8",  # SICK_SCAN_POINTFIELD_DATATYPE_FLOAT64
+}
+
+
+def _field_name(name):
+    if isinstance(name, str):
+        return name.rstrip("\x00")
+    return bytes(name).split(b"\x00", 1)[0].decode("utf-8")
+
+
+@functools.lru_cache(maxsize=64)
+def _point_dtype(field_layout, point_step, is_bigendian):
+    byte_order = ">" if is_bigendian else "<"
+    names, formats, offsets = [], [], []
+    for name, offset, datatype, count in field_layout:
+        field_format = byte_order + POINTFIELD_DATATYPES[datatype]
+        names.append(name)
+        formats.append(field_format if count <= 1 else (field_format, count))
+        offsets.append(offset)
+    return np.dtype(
+        {"names": names, "formats": formats, "offsets": offsets, "itemsize": point_step}
+    )
+
+
+def pointcloud_dtype(pointcloud_msg):
+    """Build the structured numpy dtype of a single point from the message fields.
+
+    Works on both the ctypes SickScanPointCloudMsg and lidar_pb2.SickScanPointCloudMsg.
+    """
+    msg_fields_buffer = pointcloud_msg.fields.buffer
+    field_layout = tuple(
+        (
+            _field_name(msg_fields_buffer[n].name),
+            msg_fields_buffer[n].offset,
+            msg_fields_buffer[n].datatype,
+            msg_fields_buffer[n].count,
+        )
+        for n in range(pointcloud_msg.fields.size)
+    )
+    return _point_dtype(
+        field_layout, pointcloud_msg.point_step, bool(pointcloud_msg.is_bigendian)
+    )
+
+
+def _data_buffer(pointcloud_msg):
+    buffer = pointcloud_msg.data.buffer
+    if isinstance(buffer, (bytes, bytearray, memoryview)):
+        return buffer
+    # ctypes message: data.buffer is a POINTER(c_uint8), view it as a sized array
+    return ctypes.cast(
+        buffer, ctypes.POINTER(ctypes.c_uint8 * pointcloud_msg.data.size)
+    ).contents
+
+
+def pointcloud_msg_to_points(pointcloud_msg):
+    """View the pointcloud data as a structured numpy array with one record per point.
+
+    The data buffer is not copied, so for live ctypes messages the returned array is
+    only valid inside the sick_scan callback. Copy the fields you need to keep.
+    For protobuf messages the only copy is reading the data.buffer bytes field.
+    Fields are views too, e.g. points["x"], and rows with padding (row_step larger
+    than width * point_step) are the only case where the points are copied.
+    """
+    cloud_data_buffer_len = pointcloud_msg.row_step * pointcloud_msg.height
+    assert pointcloud_msg.data.size == cloud_data_buffer_len
+
+    dtype = pointcloud_dtype(pointcloud_msg)
+    if pointcloud_msg.width * pointcloud_msg.height == 0:
+        return np.zeros(0, dtype=dtype)
+
+    points = np.ndarray(
+        shape=(pointcloud_msg.height, pointcloud_msg.width),
+        dtype=dtype,
+        buffer=_data_buffer(pointcloud_msg),
+        strides=(pointcloud_msg.row_step, pointcloud_msg.point_step),
+    )
+    return points.reshape(-1)
+
+
+def scan_time_offset_ns(pointcloud_msg, start_time):
+    """Offset of the scan timestamp from start_time, as used for the sweep (z) axis."""
+    scan_time = datetime.datetime.fromtimestamp(
+        pointcloud_msg.header.timestamp_sec
+    ) + datetime.timedelta(microseconds=pointcloud_msg.header.timestamp_nsec // 1000)
+    delta = start_time - scan_time
+    return delta.total_seconds() * 1e9 + delta.microseconds * 1000
+
+
+def pySickScanCartesianPointCloudMsgToXYZ(pointcloud_msg, start_time=None):
+    points = pointcloud_msg_to_points(pointcloud_msg)
+    assert {"x", "y", "z"}.issubset(points.dtype.names)
+
+    # astype copies, so the returned arrays outlive the message buffer
+    points_x = points["x"].astype(np.float32)
+    points_y = points["y"].astype(np.float32)
+    if start_time is None:
+        points_z = points["z"].astype(np.float32)
+    else:
+        points_z = np.full(
+            len(points), scan_time_offset_ns(pointcloud_msg, start_time), np.float32
+        )
+    return points_x, points_y, points_z
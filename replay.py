@@ -0,0 +1,134 @@
+"""Republish recorded sweeps on the event service, in place of the lidars.
+
+A stand-in for the lidars when testing the app and the viewers: the scans of a
+recording (a scan log or an older directory of scan files, see sweep_reader.py)
+are published on /data as the lidar service would, following their original
+timestamps, N times faster, or as fast as the subscribers take them.
+
+A capture of several lidars (a directory per lidar) is replayed on /data/<name>,
+the scans of all the lidars in the order of their timestamps.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+import os
+import time
+
+from merge import lidar_directories
+from scan_log import is_scan_log, scan_timestamp_ns
+from sweep_reader import SweepReader
+
+
+def replay_uris(recording: str) -> dict[str, str]:
+    """The recordings of a capture keyed by their publish uri, like the service."""
+    if is_scan_log(recording) or not lidar_directories(recording):
+        return {"/data": recording}
+    return {
+        f"/data/{name}": directory
+        for name, directory in lidar_directories(recording).items()
+    }
+
+
+def _timed_scans(uri: str, reader: SweepReader):
+    for scan in reader.scans():
+        yield scan_timestamp_ns(scan.header), uri, scan
+
+
+class SweepReplay:
+    """Publishes the scans of a recording with their original timing."""
+
+    def __init__(
+        self,
+        recording: str,
+        speed: float = 1.0,
+        repeat: bool = False,
+        restamp: bool = False,
+        logger: logging.Logger | None = None,
+    ) -> None:
+        """Initialize the replay.
+
+        Args:
+            recording: The sweep directory, or the capture directory of several
+                lidars.
+            speed: How many times faster than recorded the scans are published,
+                zero or less for as fast as possible.
+            repeat: Start over at the end of the recording, until cancelled.
+            restamp: Replace the header timestamps by the time of publishing, so
+                the scans look live (and keep increasing when repeating).
+            logger: The logger of the service.
+        """
+        self.uris = replay_uris(recording)
+        assert all(
+            os.path.isdir(directory) for directory in self.uris.values()
+        ), f"{recording}: not a recording"
+        self.speed = speed
+        self.repeat = repeat
+        self.restamp = restamp
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.passes = 0
+        self.scans_published = 0
+        # how far (s) the last scan was published behind its schedule
+        self.behind = 0.0
+
+    async def _publish_pass(self, event_service) -> None:
+        readers = [SweepReader(directory) for directory in self.uris.values()]
+        try:
+            scans = heapq.merge(
+                *(_timed_scans(uri, reader) for uri, reader in zip(self.uris, readers)),
+                key=lambda timed: timed[0],
+            )
+            first_ns = None
+            start = time.monotonic()
+            start_ns = time.time_ns()
+            for timestamp_ns, uri, scan in scans:
+                if first_ns is None:
+                    first_ns = timestamp_ns
+
+                if self.speed > 0:
+                    due = (timestamp_ns - first_ns) / 1e9 / self.speed
+                    delay = due - (time.monotonic() - start)
+                    self.behind = max(-delay, 0.0)
+                    # sleep even when behind, so the event loop keeps serving
+                    await asyncio.sleep(max(delay, 0.0))
+                else:
+                    await asyncio.sleep(0)
+
+                if self.restamp:
+                    stamp_ns = (
+                        start_ns + int((timestamp_ns - first_ns) / self.speed)
+                        if self.speed > 0
+                        else time.time_ns()
+                    )
+                    scan.header.timestamp_sec, scan.header.timestamp_nsec = divmod(
+                        stamp_ns, 1_000_000_000
+                    )
+                await event_service.publish(uri, scan)
+                self.scans_published += 1
+        finally:
+            for reader in readers:
+                reader.close()
+
+    async def publish(self, event_service) -> None:
+        """Publish the recording, once or until cancelled when repeating."""
+        while True:
+            start = time.monotonic()
+            await self._publish_pass(event_service)
+            self.passes += 1
+            self.logger.info(
+                f"replayed {list(self.uris.values())} in "
+                f"{time.monotonic() - start:.1f} s"
+            )
+            if not self.repeat:
+                return
+
+    def stats(self) -> dict:
+        return {
+            "speed": self.speed,
+            "passes": self.passes,
+            "scans_published": self.scans_published,
+            "behind": self.behind,
+        }
@@ -0,0 +1,211 @@
+"""Compress the point data of recorded scans, see ScanLogWriter(codec=...).
+
+Only data.buffer is compressed. The rest of the SickScanPointCloudMsg (header,
+fields and layout) is stored as is, so the scan log index is unchanged and
+every scan is decoded on its own, keeping the random access of the log.
+
+Codecs (with zstandard or lz4 installed):
+    zstd, lz4              lossless: the bytes of the points are shuffled, byte k
+                           of every point together, so the slowly varying sign and
+                           exponent bytes of the float32 fields compress well.
+    zstd-delta, lz4-delta  x, y and z are quantized to quantum (0.1 mm by default)
+                           and delta encoded along the scan before shuffling, the
+                           other fields stay lossless. Scans whose coordinates
+                           can not be quantized are stored losslessly.
+
+An encoded buffer starts with BUFFER_HEADER: the compressor, the transform, the
+size of the raw buffer and the quantum, followed by the compressed bytes.
+
+Usage:
+    python scan_codec.py /path/to/lidar_<date> /path/to/lidar_<date>_zstd --codec zstd
+"""
+
+from __future__ import annotations
+
+import argparse
+import struct
+
+import numpy as np
+
+import lidar_pb2
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+BUFFER_HEADER = struct.Struct("<BBId")  # compressor, transform, raw size, quantum
+
+ZSTD, LZ4 = 1, 2
+SHUFFLE, DELTA = 0, 1
+COMPRESSORS = {
+    name: compressor
+    for name, compressor, module in (("zstd", ZSTD, zstandard), ("lz4", LZ4, lz4))
+    if module is not None
+}
+SCAN_CODECS = tuple(COMPRESSORS) + tuple(f"{name}-delta" for name in COMPRESSORS)
+
+# the coordinate resolution of the delta codecs (m), LMS4000 ranges are in 0.1 mm
+QUANTUM = 0.0001
+ZSTD_LEVEL = 3
+FLOAT32 = 7  # SICK_SCAN_POINTFIELD_DATATYPE_FLOAT32
+
+
+def _compress(compressor: int, data: bytes) -> bytes:
+    if compressor == ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return lz4.block.compress(data, store_size=False)
+
+
+def _decompress(compressor: int, data, size: int) -> bytes:
+    if compressor == ZSTD:
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+    return lz4.block.decompress(data, uncompressed_size=size)
+
+
+def _shuffle(buffer, point_step: int) -> bytes:
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    body = len(data) // point_step * point_step
+    shuffled = data[:body].reshape(-1, point_step).T
+    return shuffled.tobytes() + data[body:].tobytes()
+
+
+def _unshuffle(buffer, point_step: int) -> bytearray:
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    body = len(data) // point_step * point_step
+    unshuffled = bytearray(len(data))
+    points = np.frombuffer(unshuffled, dtype=np.uint8)
+    points[:body] = data[:body].reshape(point_step, -1).T.reshape(-1)
+    points[body:] = data[body:]
+    return unshuffled
+
+
+def _xyz_offsets(scan) -> list[int] | None:
+    # the offsets of the x, y and z fields, if they can be delta encoded in place
+    if scan.is_bigendian or scan.row_step != scan.width * scan.point_step:
+        return None
+    fields = {
+        field.name.split(b"\x00", 1)[0]: field
+        for field in scan.fields.buffer[: scan.fields.size]
+    }
+    offsets = []
+    for name in (b"x", b"y", b"z"):
+        field = fields.get(name)
+        if field is None or field.datatype != FLOAT32 or field.count > 1:
+            return None
+        offsets.append(field.offset)
+    return offsets
+
+
+def _column(data, scan, offset: int, dtype: str) -> np.ndarray:
+    # one field of every point, as a writable view into data
+    return np.ndarray(
+        (scan.width * scan.height,), dtype, data, offset, (scan.point_step,)
+    )
+
+
+def _delta_encode(scan, quantum: float) -> bytearray | None:
+    offsets = _xyz_offsets(scan)
+    if offsets is None:
+        return None
+    data = bytearray(scan.data.buffer)
+    deltas = []
+    for offset in offsets:
+        values = _column(data, scan, offset, "<f4")
+        if not np.isfinite(values).all():
+            return None
+        quantized = np.round(values.astype(np.float64) / quantum).astype(np.int64)
+        delta = np.diff(quantized, prepend=0)
+        if len(delta) and np.abs(delta).max() >= 2**31:
+            return None
+        deltas.append(delta)
+    # the int32 deltas replace the float32 values, in the same place
+    for offset, delta in zip(offsets, deltas):
+        _column(data, scan, offset, "<i4")[:] = delta
+    return data
+
+
+def _delta_decode(data: bytearray, scan, quantum: float) -> None:
+    for offset in _xyz_offsets(scan):
+        quantized = np.cumsum(_column(data, scan, offset, "<i4"), dtype=np.int64)
+        _column(data, scan, offset, "<f4")[:] = quantized * quantum
+
+
+def encode_buffer(scan, codec: str, quantum: float = QUANTUM) -> bytes:
+    """Compress the point data of scan with codec, one of SCAN_CODECS."""
+    assert codec in SCAN_CODECS, f"unknown or unavailable scan codec {codec}"
+    name, _, variant = codec.partition("-")
+
+    buffer, transform = scan.data.buffer, SHUFFLE
+    if variant == "delta":
+        encoded = _delta_encode(scan, quantum)
+        if encoded is not None:
+            buffer, transform = encoded, DELTA
+
+    compressed = _compress(COMPRESSORS[name], _shuffle(buffer, scan.point_step))
+    return (
+        BUFFER_HEADER.pack(COMPRESSORS[name], transform, len(scan.data.buffer), quantum)
+        + compressed
+    )
+
+
+def decode_buffer(scan) -> bytes:
+    """Decompress the point data of a scan encoded by encode_buffer."""
+    encoded = memoryview(scan.data.buffer)
+    compressor, transform, size, quantum = BUFFER_HEADER.unpack_from(encoded)
+    assert (
+        compressor in COMPRESSORS.values()
+    ), f"the {compressor} scan compressor is not installed"
+    data = _unshuffle(
+        _decompress(compressor, encoded[BUFFER_HEADER.size :], size), scan.point_step
+    )
+    if transform == DELTA:
+        _delta_decode(data, scan, quantum)
+    return bytes(data)
+
+
+def encode_scan(
+    scan: lidar_pb2.SickScanPointCloudMsg, codec: str, quantum: float = QUANTUM
+) -> lidar_pb2.SickScanPointCloudMsg:
+    """A copy of scan with its point data compressed, scan is left unchanged."""
+    encoded = lidar_pb2.SickScanPointCloudMsg()
+    encoded.CopyFrom(scan)
+    encoded.data.buffer = encode_buffer(scan, codec, quantum)
+    return encoded
+
+
+def decode_scan(
+    scan: lidar_pb2.SickScanPointCloudMsg,
+) -> lidar_pb2.SickScanPointCloudMsg:
+    """Decompress the point data of scan in place, returning it."""
+    scan.data.buffer = decode_buffer(scan)
+    return scan
+
+
+if __name__ == "__main__":
+    from scan_log import ScanLogWriter
+    from sweep_reader import SweepReader
+
+    parser = argparse.ArgumentParser(description="Compress a recorded sweep.")
+    parser.add_argument("sweep", help="the sweep directory to compress")
+    parser.add_argument("output", help="the sweep directory to write")
+    parser.add_argument("--codec", choices=SCAN_CODECS, required=True)
+    parser.add_argument(
+        "--quantum",
+        type=float,
+        default=QUANTUM,
+        help="the coordinate resolution (m) of the -delta codecs",
+    )
+    args = parser.parse_args()
+
+    with SweepReader(args.sweep) as reader, ScanLogWriter(
+        args.output, codec=args.codec, quantum=args.quantum
+    ) as writer:
+        for scan in reader.scans():
+            writer.append_scan(scan)
+    print(args.output, flush=True)
@@ -0,0 +1,306 @@
+"""Append-only segmented log of serialized lidar_pb2.SickScanPointCloudMsg records.
+
+A sweep directory holds numbered segments, each with a sidecar index:
+
+    segment_000000.scans   SEGMENT_MAGIC, then records of u32 length + payload
+    segment_000000.index   INDEX_MAGIC, then one INDEX_RECORD per record
+
+All integers are little-endian. An index record holds the scan seq, its
+timestamp in nanoseconds, and the offset and length of the payload in the
+segment, so any scan can be read without scanning the segment. Segments are rotated by
+size or age, and writes to both files are strictly sequential.
+
+Segments written with a codec start with ENCODED_SEGMENT_MAGIC instead, their
+scans have their point data compressed (see scan_codec.py) and are decompressed
+by ScanLogReader as they are read.
+
+Scans missing from an index, after a crash or while a segment is still being
+recorded, are found by scanning the end of the segment when it is opened.
+"""
+
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+import lidar_pb2
+from scan_codec import QUANTUM, decode_scan, encode_scan
+
+SEGMENT_MAGIC = b"SCANLOG1"
+ENCODED_SEGMENT_MAGIC = b"SCANLOGZ"
+INDEX_MAGIC = b"SCANIDX1"
+SEGMENT_SUFFIX = ".scans"
+INDEX_SUFFIX = ".index"
+
+RECORD_HEADER = struct.Struct("<I")
+INDEX_RECORD = struct.Struct("<IqQI")  # seq, timestamp_ns, offset, length
+INDEX_DTYPE = np.dtype(
+    [("seq", "<u4"), ("timestamp_ns", "<i8"), ("offset", "<u8"), ("length", "<u4")]
+)
+
+MAX_SEGMENT_BYTES = 256 * 1024 * 1024
+MAX_SEGMENT_SECONDS = 300.0
+
+
+def scan_timestamp_ns(header) -> int:
+    """The scan header timestamp in nanoseconds since the epoch."""
+    return header.timestamp_sec * 1_000_000_000 + header.timestamp_nsec
+
+
+def segment_name(number: int) -> str:
+    return f"segment_{number:06d}"
+
+
+def list_segments(directory: str) -> list[str]:
+    """Return the paths of the segments in directory, without suffix, in order."""
+    names = sorted(
+        name[: -len(SEGMENT_SUFFIX)]
+        for name in os.listdir(directory)
+        if name.startswith("segment_") and name.endswith(SEGMENT_SUFFIX)
+    )
+    return [os.path.join(directory, name) for name in names]
+
+
+def is_scan_log(directory: str) -> bool:
+    return os.path.isdir(directory) and len(list_segments(directory)) > 0
+
+
+class ScanLogWriter:
+    """Appends serialized scans to rotating segment files in a sweep directory."""
+
+    def __init__(
+        self,
+        directory: str,
+        max_segment_bytes: int = MAX_SEGMENT_BYTES,
+        max_segment_seconds: float = MAX_SEGMENT_SECONDS,
+        codec: str | None = None,
+        quantum: float = QUANTUM,
+    ) -> None:
+        """Initialize the writer.
+
+        Args:
+            directory: the sweep directory, created if needed.
+            max_segment_bytes: start a new segment once a segment reaches this size.
+            max_segment_seconds: start a new segment once a segment is this old.
+                Zero or less disables rotation by age.
+            codec: compress the point data of the scans appended with append_scan,
+                one of scan_codec.SCAN_CODECS, or None to store them as is.
+            quantum: the coordinate resolution (m) of the -delta codecs.
+        """
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_seconds = max_segment_seconds
+        self.codec = codec
+        self.quantum = quantum
+        os.makedirs(directory, exist_ok=True)
+
+        # never append to segments of a previous run
+        self._next_segment = len(list_segments(directory))
+        self._segment = None
+        self._index = None
+        self._segment_size = 0
+        self._segment_opened = 0.0
+
+    def _rotate(self) -> None:
+        self._close_segment()
+        path = os.path.join(self.directory, segment_name(self._next_segment))
+        self._next_segment += 1
+
+        magic = ENCODED_SEGMENT_MAGIC if self.codec else SEGMENT_MAGIC
+        self._segment = open(path + SEGMENT_SUFFIX, "xb")
+        self._segment.write(magic)
+        self._index = open(path + INDEX_SUFFIX, "xb")
+        self._index.write(INDEX_MAGIC)
+        self._segment_size = len(magic)
+        self._segment_opened = time.monotonic()
+
+    def _needs_rotation(self) -> bool:
+        if self._segment is None or self._segment_size >= self.max_segment_bytes:
+            return True
+        age = time.monotonic() - self._segment_opened
+        return 0 < self.max_segment_seconds <= age
+
+    def append(self, seq: int, timestamp_ns: int, payload: bytes) -> None:
+        """Append one serialized scan, already encoded if the writer has a codec."""
+        if self._needs_rotation():
+            self._rotate()
+
+        offset = self._segment_size + RECORD_HEADER.size
+        self._segment.write(RECORD_HEADER.pack(len(payload)))
+        self._segment.write(payload)
+        self._index.write(INDEX_RECORD.pack(seq, timestamp_ns, offset, len(payload)))
+        self._segment_size = offset + len(payload)
+
+    def append_scan(self, scan: lidar_pb2.SickScanPointCloudMsg) -> None:
+        """Append one scan, compressing its point data if the writer has a codec."""
+        payload = (
+            encode_scan(scan, self.codec, self.quantum) if self.codec else scan
+        ).SerializeToString()
+        self.append(scan.header.seq, scan_timestamp_ns(scan.header), payload)
+
+    def flush(self) -> None:
+        """Flush the segment before its index, so the index never points past it."""
+        if self._segment is not None:
+            self._segment.flush()
+            self._index.flush()
+
+    def _close_segment(self) -> None:
+        if self._segment is not None:
+            self.flush()
+            self._segment.close()
+            self._index.close()
+            self._segment = self._index = None
+
+    def close(self) -> None:
+        self._close_segment()
+
+    def __enter__(self) -> ScanLogWriter:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def is_encoded_segment(path: str) -> bool:
+    """Whether the scans of a segment (path without suffix) are compressed."""
+    with open(path + SEGMENT_SUFFIX, "rb") as segment:
+        return segment.read(len(ENCODED_SEGMENT_MAGIC)) == ENCODED_SEGMENT_MAGIC
+
+
+def read_index(path: str) -> np.ndarray:
+    """Read the index of a segment (path without suffix) as an INDEX_DTYPE array.
+
+    A partially written trailing record, e.g. after a power loss, is ignored.
+    Scans missing from the index, or a missing index, are recovered from the
+    segment, see rebuild_index.
+    """
+    try:
+        with open(path + INDEX_SUFFIX, "rb") as index_file:
+            data = index_file.read()
+    except FileNotFoundError:
+        data = b""
+    if len(data) < len(INDEX_MAGIC):
+        return rebuild_index(path)
+
+    assert data[: len(INDEX_MAGIC)] == INDEX_MAGIC, f"{path} has no scan index"
+    count = (len(data) - len(INDEX_MAGIC)) // INDEX_DTYPE.itemsize
+    index = np.frombuffer(data, dtype=INDEX_DTYPE, count=count, offset=len(INDEX_MAGIC))
+    end = int(index[-1]["offset"] + index[-1]["length"]) if count else 0
+    if end < os.path.getsize(path + SEGMENT_SUFFIX):
+        return rebuild_index(path, index)
+    return index
+
+
+def rebuild_index(path: str, index: np.ndarray | None = None) -> np.ndarray:
+    """Complete the index of a segment by scanning its records, e.g. after a crash.
+
+    Only the records after the last one of index are read, all of them without
+    an index. Nothing is written, as the segment may still be being recorded. A
+    segment shorter than its magic, e.g. just rotated to, holds no records.
+    """
+    records = []
+    with open(path + SEGMENT_SUFFIX, "rb") as segment:
+        if index is not None and len(index):
+            offset = int(index[-1]["offset"] + index[-1]["length"])
+            segment.seek(offset)
+        else:
+            magic = segment.read(len(SEGMENT_MAGIC))
+            if len(magic) < len(SEGMENT_MAGIC):
+                return np.zeros(0, dtype=INDEX_DTYPE)
+            if magic not in (SEGMENT_MAGIC, ENCODED_SEGMENT_MAGIC):
+                raise ValueError(f"{path}{SEGMENT_SUFFIX} is not a scan log segment")
+            offset = len(SEGMENT_MAGIC)
+        while True:
+            length_bytes = segment.read(RECORD_HEADER.size)
+            if len(length_bytes) < RECORD_HEADER.size:
+                break
+            (length,) = RECORD_HEADER.unpack(length_bytes)
+            payload = segment.read(length)
+            if len(payload) < length:
+                break  # truncated last record
+            offset += RECORD_HEADER.size
+            scan = lidar_pb2.SickScanPointCloudMsg.FromString(payload)
+            records.append(
+                (scan.header.seq, scan_timestamp_ns(scan.header), offset, length)
+            )
+            offset += length
+
+    recovered = np.array(records, dtype=INDEX_DTYPE)
+    if index is None or not records:
+        return recovered if index is None else index
+    return np.concatenate([index, recovered])
+
+
+class ScanLogReader:
+    """Random access to the scans of a sweep directory through the segment indexes.
+
+    Segments are memory mapped, so reading a scan does not copy its payload and
+    only the pages of the scans actually read are loaded.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self._segments = list_segments(directory)
+        indexes = [read_index(path) for path in self._segments]
+        self.index = (
+            np.concatenate(indexes) if indexes else np.zeros(0, dtype=INDEX_DTYPE)
+        )
+        # the segment number of every scan in self.index
+        self.segment_of = np.repeat(
+            np.arange(len(indexes), dtype=np.intp), [len(i) for i in indexes]
+        )
+        self._mappings: dict[int, mmap.mmap] = {}
+        # whether the point data of the scans of each segment is compressed
+        self._encoded = [is_encoded_segment(path) for path in self._segments]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _mapping(self, segment: int) -> mmap.mmap:
+        if segment not in self._mappings:
+            with open(self._segments[segment] + SEGMENT_SUFFIX, "rb") as segment_file:
+                mapping = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mapping, "madvise"):
+                mapping.madvise(mmap.MADV_SEQUENTIAL)
+            self._mappings[segment] = mapping
+        return self._mappings[segment]
+
+    def read(self, i: int) -> memoryview:
+        """Return the serialized scan i, as a view into its memory mapped segment.
+
+        The point data of scans of encoded segments is still compressed, see
+        is_encoded().
+        """
+        record = self.index[i]
+        offset = int(record["offset"])
+        mapping = self._mapping(int(self.segment_of[i]))
+        return memoryview(mapping)[offset : offset + int(record["length"])]
+
+    def is_encoded(self, i: int) -> bool:
+        return self._encoded[int(self.segment_of[i])]
+
+    def __getitem__(self, i: int) -> lidar_pb2.SickScanPointCloudMsg:
+        scan = lidar_pb2.SickScanPointCloudMsg.FromString(self.read(i))
+        return decode_scan(scan) if self.is_encoded(i) else scan
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self) -> None:
+        for mapping in self._mappings.values():
+            try:
+                mapping.close()
+            except BufferError:
+                pass  # views returned by read() are still alive, unmapped once freed
+        self._mappings.clear()
+
+    def __enter__(self) -> ScanLogReader:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,325 @@
+"""Persist lidar scans to disk away from the sick_scan callback thread.
+
+The callback only copies the raw point buffer of each scan into a slot of a
+preallocated ScanRing. A ScanWriter thread converts each queued scan to
+lidar_pb2.SickScanPointCloudMsg and hands it to an optional listener (e.g. for
+publishing) right away, while a second thread writes the converted scans to disk
+in batches. So a slow disk neither stalls the driver's receive thread nor delays
+the live scans, it only drops scans from the recording once too many are waiting.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import logging
+import queue
+import threading
+import time
+from typing import Callable, NamedTuple
+
+import lidar_pb2
+from latency import metrics
+from scan_log import ScanLogWriter
+
+DATE_FORMAT = "%Y-%m-%d_%H-%M-%S_%f"
+
+
+class RawScan(NamedTuple):
+    """The metadata of a scan whose point buffer was copied into a ring slot."""
+
+    slot: int
+    size: int
+    capacity: int
+    header: tuple  # (seq, timestamp_sec, timestamp_nsec, frame_id)
+    layout: tuple  # (height, width, is_bigendian, point_step, row_step, is_dense, num_echos, segment_idx)
+    fields: tuple  # ((name, offset, datatype, count), ...)
+
+
+class ScanRing:
+    """A fixed number of preallocated buffers for raw scan data."""
+
+    def __init__(self, num_slots: int = 256, slot_size: int = 64 * 1024) -> None:
+        self._slots = [bytearray(slot_size) for _ in range(num_slots)]
+        self._free: queue.SimpleQueue = queue.SimpleQueue()
+        for slot in range(num_slots):
+            self._free.put(slot)
+
+    def acquire(self) -> int | None:
+        """Return a free slot, or None when every slot is in use."""
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            return None
+
+    def release(self, slot: int) -> None:
+        self._free.put(slot)
+
+    def copy_in(self, slot: int, source, size: int) -> None:
+        """Copy size bytes from a ctypes pointer into the slot."""
+        if len(self._slots[slot]) < size:
+            # only happens when a scan is larger than any seen before
+            self._slots[slot] = bytearray(size)
+        destination = (ctypes.c_char * size).from_buffer(self._slots[slot])
+        ctypes.memmove(destination, source, size)
+
+    def view(self, slot: int, size: int) -> memoryview:
+        return memoryview(self._slots[slot])[:size]
+
+
+class ScanLogSink:
+    """Appends the scans to a segmented scan log in base_dir, see scan_log.py.
+
+    With a codec (see ScanLogWriter) the point data is compressed here, in the
+    writer thread.
+    """
+
+    def __init__(self, base_dir: str, **kwargs) -> None:
+        self.base_dir = base_dir
+        self._log = ScanLogWriter(base_dir, **kwargs)
+
+    def write(
+        self, records: list[tuple[RawScan, lidar_pb2.SickScanPointCloudMsg]]
+    ) -> None:
+        for _, scan in records:
+            self._log.append_scan(scan)
+        self._log.flush()
+
+    def close(self) -> None:
+        self._log.close()
+
+
+class ScanWriter(threading.Thread):
+    """Converts queued scans to protos in a thread, a second thread writes them out."""
+
+    def __init__(
+        self,
+        sink,
+        on_scan: Callable[[lidar_pb2.SickScanPointCloudMsg], None] | None = None,
+        ring: ScanRing | None = None,
+        batch_size: int = 64,
+        max_pending_writes: int = 256,
+        slow_write_threshold: float = 0.05,
+        logger: logging.Logger | None = None,
+    ) -> None:
+        """Initialize the writer.
+
+        Args:
+            sink: where the converted scans are written, see ScanLogSink.
+            on_scan: called from the writer thread with every converted scan, as
+                soon as it is converted.
+            ring: the buffers used to hand scans over from the callback thread.
+            batch_size: the maximum number of scans written to the sink at once.
+            max_pending_writes: the number of converted scans waiting for the
+                disk, further scans are published but not recorded.
+            slow_write_threshold: batch writes slower than this (seconds) are logged.
+            logger: the logger used to report slow writes and failures.
+        """
+        super().__init__(name="scan-writer", daemon=True)
+        self._sink = sink
+        self._on_scan = on_scan
+        self._ring = ring if ring is not None else ScanRing()
+        self._batch_size = batch_size
+        self._slow_write_threshold = slow_write_threshold
+        self._logger = logger if logger is not None else logging.getLogger(__name__)
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._records: queue.Queue = queue.Queue(maxsize=max_pending_writes)
+        self._disk_writer = threading.Thread(
+            target=self._write_records, name="scan-writer-disk", daemon=True
+        )
+
+        self.scans_submitted = 0
+        self.scans_dropped = 0
+        self.scans_failed = 0
+        self.writes_dropped = 0
+        self.scans_written = 0
+        self.slow_writes = 0
+        self.max_write_latency = 0.0
+        # why the conversion or the disk writes stopped, if they failed
+        self.error: str | None = None
+        self._converter_failed = False
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, message_contents) -> None:
+        """Copy a ctypes SickScanPointCloudMsg for writing. Called from the callback."""
+        self.scans_submitted += 1
+        slot = None if self._converter_failed else self._ring.acquire()
+        if slot is None:
+            self.scans_dropped += 1
+            return
+
+        size = message_contents.data.size
+        self._ring.copy_in(slot, message_contents.data.buffer, size)
+        header = message_contents.header
+        fields = message_contents.fields
+        self._queue.put(
+            RawScan(
+                slot=slot,
+                size=size,
+                capacity=message_contents.data.capacity,
+                header=(
+                    header.seq,
+                    header.timestamp_sec,
+                    header.timestamp_nsec,
+                    bytes(header.frame_id),
+                ),
+                layout=(
+                    message_contents.height,
+                    message_contents.width,
+                    message_contents.is_bigendian,
+                    message_contents.point_step,
+                    message_contents.row_step,
+                    message_contents.is_dense,
+                    message_contents.num_echos,
+                    message_contents.segment_idx,
+                ),
+                fields=tuple(
+                    (
+                        fields.buffer[n].name,
+                        fields.buffer[n].offset,
+                        fields.buffer[n].datatype,
+                        fields.buffer[n].count,
+                    )
+                    for n in range(fields.size)
+                ),
+            )
+        )
+
+    def stop(self) -> None:
+        """Write the remaining scans and stop the thread."""
+        self._queue.put(None)
+        self.join()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "pending_writes": self._records.qsize(),
+            "scans_submitted": self.scans_submitted,
+            "scans_dropped": self.scans_dropped,
+            "scans_failed": self.scans_failed,
+            "writes_dropped": self.writes_dropped,
+            "scans_written": self.scans_written,
+            "slow_writes": self.slow_writes,
+            "max_write_latency": self.max_write_latency,
+            "error": self.error,
+        }
+
+    def _to_proto(self, raw: RawScan) -> lidar_pb2.SickScanPointCloudMsg:
+        protocolbuf = lidar_pb2.SickScanPointCloudMsg()
+
+        height, width, is_bigendian, point_step, row_step = raw.layout[:5]
+        is_dense, num_echos, segment_idx = raw.layout[5:]
+        protocolbuf.height = height
+        protocolbuf.width = width
+        protocolbuf.is_bigendian = is_bigendian
+        protocolbuf.point_step = point_step
+        protocolbuf.row_step = row_step
+        protocolbuf.is_dense = is_dense
+        protocolbuf.num_echos = num_echos
+        protocolbuf.segment_idx = segment_idx
+
+        seq, timestamp_sec, timestamp_nsec, frame_id = raw.header
+        protocolbuf.header.seq = seq
+        protocolbuf.header.timestamp_sec = timestamp_sec
+        protocolbuf.header.timestamp_nsec = timestamp_nsec
+        protocolbuf.header.frame_id = frame_id
+
+        protocolbuf.data.capacity = raw.capacity
+        protocolbuf.data.size = raw.size
+        protocolbuf.data.buffer = bytes(self._ring.view(raw.slot, raw.size))
+
+        protocolbuf.fields.capacity = len(raw.fields)
+        protocolbuf.fields.size = len(raw.fields)
+        for name, offset, datatype, count in raw.fields:
+            field = protocolbuf.fields.buffer.add()
+            field.name = name
+            field.offset = offset
+            field.datatype = datatype
+            field.count = count
+
+        return protocolbuf
+
+    def run(self) -> None:
+        self._disk_writer.start()
+        try:
+            while True:
+                raw = self._queue.get()
+                if raw is None:
+                    break
+                self._convert(raw)
+        except Exception as error:
+            self.error = repr(error)
+            self._converter_failed = True
+            self._logger.exception("Scan writer failed, dropping all further scans")
+        finally:
+            # a failed disk writer no longer takes scans, so do not wait for it
+            while self._disk_writer.is_alive():
+                try:
+                    self._records.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            self._disk_writer.join()
+
+    def _convert(self, raw: RawScan) -> None:
+        try:
+            start = metrics.clock()
+            try:
+                protocolbuf = self._to_proto(raw)
+            finally:
+                self._ring.release(raw.slot)
+            metrics.stage("to_proto", start)
+            if self._on_scan is not None:
+                self._on_scan(protocolbuf)
+        except Exception:
+            self.scans_failed += 1
+            self._logger.exception(f"Failed to convert scan {raw.header[0]}")
+            return
+
+        if self._disk_writer.is_alive():
+            try:
+                self._records.put_nowait((raw, protocolbuf))
+            except queue.Full:
+                self.writes_dropped += 1
+        else:
+            self.writes_dropped += 1
+
+    def _next_batch(self) -> tuple[list, bool]:
+        batch = [self._records.get()]
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(self._records.get_nowait())
+            except queue.Empty:
+                break
+        stopping = None in batch
+        return [record for record in batch if record is not None], stopping
+
+    def _write_records(self) -> None:
+        try:
+            stopping = False
+            while not stopping:
+                records, stopping = self._next_batch()
+                if not records:
+                    continue
+
+                start = time.monotonic()
+                self._sink.write(records)
+                latency = time.monotonic() - start
+                metrics.observe("disk_write", latency)
+                self.scans_written += len(records)
+
+                self.max_write_latency = max(self.max_write_latency, latency)
+                if latency > self._slow_write_threshold:
+                    self.slow_writes += 1
+                    self._logger.warning(
+                        f"Writing {len(records)} scans took {latency * 1000:.1f} ms, "
+                        f"{self._records.qsize()} scans waiting"
+                    )
+            self._sink.close()
+        except Exception as error:
+            self.error = repr(error)
+            self._logger.exception(
+                f"Writing scans to {self._sink.base_dir} failed, recording stopped"
+            )
@@ -0,0 +1,104 @@
+"""Lazily loaded bindings to the SICK sick_scan_xd driver library.
+
+Only lidar_service.py needs the driver. The sick_scan_api module and
+libsick_scan_xd_shared_lib.so are loaded when a driver is opened, so importing
+this module (or anything else in the app) never touches the shared library.
+"""
+
+from __future__ import annotations
+
+import os
+from typing import Callable
+
+APP_DIRECTORY = "/mnt/managed_home/farm-ng-user-gsainsbury/amiga-fastapi"
+LIBRARY_PATHS = [os.path.join(APP_DIRECTORY, "sick_scan_ws/build/")]
+LIBRARY_NAME = "libsick_scan_xd_shared_lib.so"
+
+
+def launch_args(lidar_address: str) -> str:
+    """The sick_scan launch arguments for an LMS4xxx at lidar_address."""
+    launch_file = os.path.join(
+        APP_DIRECTORY, "sick_scan_ws/sick_scan_xd/launch/sick_lms_4xxx.launch"
+    )
+    return f"{launch_file} hostname:={lidar_address}"
+
+
+class SickScanDriver:
+    """One sick_scan API handle delivering cartesian pointclouds to a callback.
+
+    Opening the driver (loading the library and initializing the lidar) takes
+    seconds, registering the callback does not. So the driver is opened once and
+    kept open between captures, which only register and deregister the callback.
+    """
+
+    def __init__(self, cli_args: str, callback: Callable) -> None:
+        """Initialize the driver, without loading the library.
+
+        Args:
+            cli_args: the launch file and arguments passed to SickScanApiInitByLaunchfile.
+            callback: called from the driver thread as callback(api_handle, pointcloud_msg).
+        """
+        self.cli_args = cli_args
+        self._callback = callback
+        self._api = None
+        self._library = None
+        self._api_handle = None
+        self._ctypes_callback = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._api_handle is not None
+
+    @property
+    def running(self) -> bool:
+        """Whether pointclouds are delivered to the callback."""
+        return self._ctypes_callback is not None
+
+    def open(self) -> None:
+        """Load the library and connect to the lidar, if not done yet. Blocks for a while."""
+        if self.is_open:
+            return
+        import sick_scan_api as api
+
+        library = api.SickScanApiLoadLibrary(LIBRARY_PATHS, LIBRARY_NAME)
+        api_handle = None
+        try:
+            api_handle = api.SickScanApiCreate(library)
+            api.SickScanApiInitByLaunchfile(library, api_handle, self.cli_args)
+        except Exception:
+            # leave the driver closed, so the next capture opens it again
+            if api_handle is not None:
+                api.SickScanApiRelease(library, api_handle)
+            api.SickScanApiUnloadLibrary(library)
+            raise
+        self._api, self._library, self._api_handle = api, library, api_handle
+
+    def register(self) -> None:
+        """Start delivering pointclouds to the callback."""
+        if self.running:
+            return
+        # keep a reference, ctypes callbacks must outlive their registration
+        self._ctypes_callback = self._api.SickScanPointCloudMsgCallback(self._callback)
+        self._api.SickScanApiRegisterCartesianPointCloudMsg(
+            self._library, self._api_handle, self._ctypes_callback
+        )
+
+    def deregister(self) -> None:
+        """Stop delivering pointclouds to the callback, the lidar stays connected."""
+        if not self.running:
+            return
+        self._api.SickScanApiDeregisterCartesianPointCloudMsg(
+            self._library, self._api_handle, self._ctypes_callback
+        )
+        self._ctypes_callback = None
+
+    def close(self) -> None:
+        """Deregister the callback, close the lidar and unload the library."""
+        if not self.is_open:
+            return
+        self.deregister()
+        api = self._api
+        api.SickScanApiClose(self._library, self._api_handle)
+        api.SickScanApiRelease(self._library, self._api_handle)
+        api.SickScanApiUnloadLibrary(self._library)
+        self._library = self._api_handle = None
@@ -0,0 +1,135 @@
+"""Lazily stream the scans of a recorded sweep in constant memory.
+
+Reads both the segmented scan logs written by lidar_service.py (see scan_log.py)
+and the older sweep directories holding one serialized scan per file. Files are
+memory mapped and scans are parsed one at a time as the generators advance, so
+arbitrarily long recordings can be processed without loading them.
+"""
+
+from __future__ import annotations
+
+import mmap
+import os
+from typing import Iterator
+
+import numpy as np
+
+import lidar_pb2
+from pointcloud import pointcloud_msg_to_points
+from scan_log import ScanLogReader, is_scan_log, scan_timestamp_ns
+
+
+class SweepReader:
+    """Iterate over the scans of a sweep directory, optionally within a range.
+
+    Ranges are half open: start_time <= timestamp_ns < end_time and
+    start_seq <= seq < end_seq, where timestamps are nanoseconds since the epoch.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self._log: ScanLogReader | None = None
+        self._files: list[str] = []
+        if is_scan_log(directory):
+            self._log = ScanLogReader(directory)
+        else:
+            paths = (
+                os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            )
+            # e.g. the directories of the lidars of a capture are not scans
+            self._files = [
+                path
+                for path in paths
+                if os.path.isfile(path) and os.path.getsize(path) > 0
+            ]
+
+    def __len__(self) -> int:
+        return len(self._log) if self._log is not None else len(self._files)
+
+    def close(self) -> None:
+        if self._log is not None:
+            self._log.close()
+
+    def __enter__(self) -> SweepReader:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def select(
+        self,
+        start_time: int | None = None,
+        end_time: int | None = None,
+        start_seq: int | None = None,
+        end_seq: int | None = None,
+    ) -> np.ndarray:
+        """Return the positions of the scans within the range (scan logs only)."""
+        assert self._log is not None, "range selection needs a scan log index"
+        index = self._log.index
+        mask = np.ones(len(index), dtype=bool)
+        if start_time is not None:
+            mask &= index["timestamp_ns"] >= start_time
+        if end_time is not None:
+            mask &= index["timestamp_ns"] < end_time
+        if start_seq is not None:
+            mask &= index["seq"] >= start_seq
+        if end_seq is not None:
+            mask &= index["seq"] < end_seq
+        return np.flatnonzero(mask)
+
+    def _in_range(self, header, start_time, end_time, start_seq, end_seq) -> bool:
+        timestamp_ns = scan_timestamp_ns(header)
+        return (
+            (start_time is None or timestamp_ns >= start_time)
+            and (end_time is None or timestamp_ns < end_time)
+            and (start_seq is None or header.seq >= start_seq)
+            and (end_seq is None or header.seq < end_seq)
+        )
+
+    def scans(
+        self,
+        start_time: int | None = None,
+        end_time: int | None = None,
+        start_seq: int | None = None,
+        end_seq: int | None = None,
+    ) -> Iterator[lidar_pb2.SickScanPointCloudMsg]:
+        """Yield the parsed scans within the range, in recording order."""
+        if self._log is not None:
+            for i in self.select(start_time, end_time, start_seq, end_seq):
+                yield self._log[i]
+            return
+
+        # one scan per file: there is no index, so filter on the parsed headers
+        for file_path in self._files:
+            scan = self._read_file(file_path)
+            if self._in_range(scan.header, start_time, end_time, start_seq, end_seq):
+                yield scan
+
+    def scans_at(
+        self, start: int, stop: int
+    ) -> Iterator[lidar_pb2.SickScanPointCloudMsg]:
+        """Yield the scans at positions start to stop (exclusive) of the recording."""
+        stop = min(stop, len(self))
+        for i in range(start, stop):
+            if self._log is not None:
+                yield self._log[i]
+            else:
+                yield self._read_file(self._files[i])
+
+    @staticmethod
+    def _read_file(file_path: str) -> lidar_pb2.SickScanPointCloudMsg:
+        with open(file_path, "rb") as scan_file, mmap.mmap(
+            scan_file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mapping, memoryview(mapping) as view:
+            return lidar_pb2.SickScanPointCloudMsg.FromString(view)
+
+    def points(
+        self,
+        start_time: int | None = None,
+        end_time: int | None = None,
+        start_seq: int | None = None,
+        end_seq: int | None = None,
+    ) -> Iterator[tuple[lidar_pb2.SickScanPointCloudMsg, np.ndarray]]:
+        """Yield each scan within the range with its points as a structured array."""
+        for scan in self.scans(start_time, end_time, start_seq, end_seq):
+            yield scan, pointcloud_msg_to_points(scan)
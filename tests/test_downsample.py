@@ -0,0 +1,33 @@
+import numpy as np
+
+from downsample import PointReduction, voxel_downsample
+
+
+def test_voxel_downsample_averages_each_voxel():
+    x = np.array([0.1, 0.3, 1.5], dtype=np.float32)
+    y = np.array([0.1, 0.1, 0.1], dtype=np.float32)
+    z = np.array([0.0, 0.2, 0.0], dtype=np.float32)
+
+    x, y, z = voxel_downsample(x, y, z, 1.0)
+
+    np.testing.assert_allclose(sorted(x), [0.2, 1.5], rtol=1e-6)
+    np.testing.assert_allclose(sorted(z), [0.0, 0.1], rtol=1e-6)
+
+
+def test_voxel_downsample_drops_non_finite_points():
+    x = np.array([0.1, np.nan, 0.3, np.inf], dtype=np.float32)
+    y = np.array([0.1, 0.1, 0.1, 0.1], dtype=np.float32)
+    z = np.array([0.0, 0.0, -np.inf, 0.0], dtype=np.float32)
+
+    x, y, z = voxel_downsample(x, y, z, 1.0)
+
+    np.testing.assert_allclose(x, [0.1])
+    assert np.isfinite(z).all()
+
+
+def test_voxel_downsample_of_only_non_finite_points_is_empty():
+    nan = np.full(3, np.nan, dtype=np.float32)
+
+    x, y, z = PointReduction(voxel_size=0.5).apply(nan, nan, nan, planar=True)
+
+    assert len(x) == len(y) == len(z) == 0
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import lidar_pb2
+from scan_log import (
+    INDEX_SUFFIX,
+    SEGMENT_SUFFIX,
+    ScanLogReader,
+    ScanLogWriter,
+    rebuild_index,
+    segment_name,
+)
+
+
+def make_scan(seq):
+    scan = lidar_pb2.SickScanPointCloudMsg()
+    scan.header.seq = seq
+    scan.header.timestamp_sec = 1_700_000_000 + seq
+    return scan
+
+
+def write_sweep(directory, count):
+    with ScanLogWriter(str(directory)) as writer:
+        for seq in range(count):
+            writer.append_scan(make_scan(seq))
+
+
+def test_reads_a_sweep_with_an_empty_last_segment(tmp_path):
+    write_sweep(tmp_path, 3)
+    # a segment just rotated to, its magic still buffered, or left by a crash
+    path = os.path.join(tmp_path, segment_name(1))
+    open(path + SEGMENT_SUFFIX, "wb").close()
+    open(path + INDEX_SUFFIX, "wb").close()
+
+    with ScanLogReader(str(tmp_path)) as reader:
+        assert len(reader) == 3
+        assert [scan.header.seq for scan in reader] == [0, 1, 2]
+
+
+def test_recovers_the_scans_of_a_missing_index(tmp_path):
+    write_sweep(tmp_path, 3)
+    os.remove(os.path.join(tmp_path, segment_name(0) + INDEX_SUFFIX))
+
+    with ScanLogReader(str(tmp_path)) as reader:
+        assert [scan.header.seq for scan in reader] == [0, 1, 2]
+
+
+def test_rebuild_index_rejects_other_files(tmp_path):
+    path = os.path.join(tmp_path, segment_name(0))
+    with open(path + SEGMENT_SUFFIX, "wb") as segment:
+        segment.write(b"NOTASCANLOG")
+
+    with pytest.raises(ValueError):
+        rebuild_index(path)
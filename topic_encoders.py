@@ -0,0 +1,182 @@
+"""Encode the messages of event service topics for the websocket viewers.
+
+Formats:
+    json      the message as a JSON object, with the same field names and value
+              representation as MessageToDict, serialized once (with orjson when
+              it is installed).
+    protobuf  the serialized message bytes, for viewers with the .proto files.
+    msgpack   the message as a MessagePack map, with raw bytes and native 64 bit
+              integers (only when msgpack is installed).
+
+Messages are converted to dicts by converters built once per message type from
+its descriptor, instead of reflecting on every field of every message.
+"""
+
+from __future__ import annotations
+
+import base64
+import functools
+import json
+import math
+from typing import Callable
+
+import numpy as np
+from google.protobuf.descriptor import FieldDescriptor
+from google.protobuf.json_format import MessageToDict
+
+try:
+    # the float32 rounding used by MessageToDict
+    from google.protobuf.internal.type_checkers import ToShortestFloat
+except ImportError:
+    ToShortestFloat = float
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+TOPIC_FORMATS = ("json", "protobuf") + (("msgpack",) if msgpack is not None else ())
+
+INT64_TYPES = {
+    FieldDescriptor.TYPE_INT64,
+    FieldDescriptor.TYPE_UINT64,
+    FieldDescriptor.TYPE_SINT64,
+    FieldDescriptor.TYPE_FIXED64,
+    FieldDescriptor.TYPE_SFIXED64,
+}
+# types with their own JSON representation, converted by MessageToDict
+WELL_KNOWN_TYPES = {
+    f"google.protobuf.{name}"
+    for name in (
+        "Any Duration FieldMask ListValue Struct Timestamp Value BoolValue BytesValue"
+        " DoubleValue FloatValue Int32Value Int64Value StringValue UInt32Value"
+        " UInt64Value"
+    ).split()
+}
+
+
+def _to_list(obj):
+    # arrays orjson can not serialize directly, e.g. strided views
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+
+    def dumps_json(obj) -> str:
+        """Serialize obj, which may contain numpy arrays, to compact JSON text."""
+        return orjson.dumps(
+            obj, default=_to_list, option=orjson.OPT_SERIALIZE_NUMPY
+        ).decode()
+
+else:
+
+    def dumps_json(obj) -> str:
+        """Serialize obj, which may contain numpy arrays, to compact JSON text."""
+        return json.dumps(
+            obj, separators=(",", ":"), ensure_ascii=False, default=_to_list
+        )
+
+
+def _is_repeated(field) -> bool:
+    # newer protobuf releases replaced FieldDescriptor.label by is_repeated
+    if hasattr(field, "is_repeated"):
+        return field.is_repeated
+    return field.label == FieldDescriptor.LABEL_REPEATED
+
+
+def _json_double(value: float):
+    # as MessageToDict, JSON has no literals for the special values
+    if math.isfinite(value):
+        return value
+    return "NaN" if math.isnan(value) else ("Infinity" if value > 0 else "-Infinity")
+
+
+def _json_float(value: float):
+    # ToShortestFloat does not terminate for NaN, check the special values first
+    if math.isfinite(value):
+        return ToShortestFloat(value)
+    return _json_double(value)
+
+
+def _value_converter(field, binary: bool) -> Callable | None:
+    # converts one value of the field, None when the value can be used as is
+    if field.type == FieldDescriptor.TYPE_MESSAGE:
+        message_type = field.message_type
+        return lambda value: message_converter(message_type, binary)(value)
+    if field.type == FieldDescriptor.TYPE_ENUM:
+        names = {value.number: value.name for value in field.enum_type.values}
+        return lambda value: names.get(value, value)
+    if field.type == FieldDescriptor.TYPE_BYTES and not binary:
+        return lambda value: base64.b64encode(value).decode("ascii")
+    if field.type in INT64_TYPES and not binary:
+        return str
+    if field.type == FieldDescriptor.TYPE_DOUBLE and not binary:
+        return _json_double
+    if field.type == FieldDescriptor.TYPE_FLOAT and not binary:
+        return _json_float
+    return None
+
+
+def _field_converter(field, binary: bool) -> Callable:
+    if (
+        field.type == FieldDescriptor.TYPE_MESSAGE
+        and field.message_type.GetOptions().map_entry
+    ):
+        key_field = field.message_type.fields_by_name["key"]
+        value = _value_converter(
+            field.message_type.fields_by_name["value"], binary
+        ) or (lambda value: value)
+        if key_field.type == FieldDescriptor.TYPE_BOOL and not binary:
+            key = lambda key: "true" if key else "false"  # noqa: E731
+        else:
+            key = (lambda key: key) if binary else str
+        return lambda values: {key(k): value(v) for k, v in values.items()}
+
+    value = _value_converter(field, binary)
+    if _is_repeated(field):
+        if value is None:
+            return list
+        return lambda values: [value(v) for v in values]
+    return value or (lambda value: value)
+
+
+@functools.lru_cache(maxsize=None)
+def message_converter(descriptor, binary: bool = False) -> Callable[..., dict]:
+    """Return a function converting messages of the descriptor's type to dicts.
+
+    Like MessageToDict, only the fields which are set are included, keyed by their
+    JSON (lowerCamelCase) names. With binary=True bytes and 64 bit integers are
+    kept as is instead of being base64 and string encoded.
+    """
+    if descriptor.full_name in WELL_KNOWN_TYPES:
+        return MessageToDict
+
+    fields = {
+        field.number: (field.json_name, _field_converter(field, binary))
+        for field in descriptor.fields
+    }
+
+    def convert(message) -> dict:
+        result = {}
+        for field, value in message.ListFields():
+            name, convert_value = fields[field.number]
+            result[name] = convert_value(value)
+        return result
+
+    return convert
+
+
+def encode_message(message, format: str = "json"):
+    """Encode a message for the websocket, as text for json or bytes otherwise."""
+    if format == "protobuf":
+        return message.SerializeToString()
+    if format == "msgpack":
+        return msgpack.packb(message_converter(message.DESCRIPTOR, True)(message))
+    return dumps_json(message_converter(message.DESCRIPTOR)(message))
@@ -1,6 +1,14 @@
 import { useState, useEffect } from 'react';
 import { JsonView, allExpanded, defaultStyles } from 'react-json-view-lite';
 import 'react-json-view-lite/dist/index.css';
+import { decodeScanFrame, summarizeScanFrame } from '../scanFrame';
+
+// topics which can be streamed as binary scan frames, with several lidars
+// each one is published under its own name, e.g. lidar/data/102
+const BINARY_URIS = ['lidar/data'];
+
+const isBinaryUri = (uri: string) =>
+    BINARY_URIS.some((binaryUri) => uri === binaryUri || uri.startsWith(binaryUri + '/'));
 
 function TopicMonitor() {
     const [uris, setUris] = useState<string[]>([]);
@@ -33,15 +41,21 @@ function TopicMonitor() {
     useEffect(() => {
         if (!selectedUri) return;
 
+        const query = isBinaryUri(selectedUri) ? '?format=binary' : '';
         const detailSocket = new WebSocket(
-            `ws://${window.location.hostname}:8042/subscribe/${selectedUri}`
+            `ws://${window.location.hostname}:8042/subscribe/${selectedUri}${query}`
         );
+        detailSocket.binaryType = 'arraybuffer';
 
         detailSocket.onopen = (event) => {
             console.log('Detail WebSocket connection opened:', event);
         };
 
         detailSocket.onmessage = (event) => {
+            if (event.data instanceof ArrayBuffer) {
+                setDetails(summarizeScanFrame(decodeScanFrame(event.data)));
+                return;
+            }
             const receivedDetails = JSON.parse(event.data);
             setDetails(receivedDetails);
         }
@@ -0,0 +1,27 @@
+// Types of scanFrame.js.
+
+export interface ScanFrame {
+    seq: number;
+    timestampSec: number;
+    timestampNsec: number;
+    numPoints: number;
+    fields: Record<string, Float32Array>;
+}
+
+export interface ScanFrameSummary {
+    seq: number;
+    timestamp: number;
+    numPoints: number;
+    fields: Record<string, { min: number; max: number }>;
+}
+
+export function decodeScanFrame(buffer: ArrayBuffer): ScanFrame;
+
+export function decodeDeltaFrame(buffer: ArrayBuffer, keyframe: ScanFrame): ScanFrame;
+
+export class ScanFrameDecoder {
+    keyframe: ScanFrame | null;
+    decode(buffer: ArrayBuffer): ScanFrame | null;
+}
+
+export function summarizeScanFrame(frame: ScanFrame): ScanFrameSummary;
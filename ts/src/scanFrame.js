@@ -0,0 +1,126 @@
+// Decoder for the binary lidar frames streamed by /subscribe/lidar/data?format=binary,
+// and the keyframes and delta frames of format=delta. The layouts are documented
+// in frames.py.
+//
+// Plain JavaScript so it is shared as is: the React app imports it (typed by
+// scanFrame.d.ts) and main.py serves it to templates/simple_lidar.html as
+// /scanFrame.js.
+
+const FRAME_MAGIC = 'SCAN';
+const FRAME_VERSION = 1;
+const FRAME_HEADER_SIZE = 24;
+const DELTA_MAGIC = 'SCND';
+const DELTA_VERSION = 1;
+const DELTA_HEADER_SIZE = 32;
+const DELTA_MISSING = -32768;
+
+function frameMagic(buffer) {
+    return String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+}
+
+function fieldNames(buffer, offset, numFields, namesLength) {
+    return numFields === 0 ? [] : new TextDecoder('ascii')
+        .decode(new Uint8Array(buffer, offset, namesLength))
+        .split(',');
+}
+
+export function decodeScanFrame(buffer) {
+    const view = new DataView(buffer);
+    if (frameMagic(buffer) !== FRAME_MAGIC || view.getUint8(4) !== FRAME_VERSION) {
+        throw new Error('Unsupported scan frame');
+    }
+    const numFields = view.getUint8(5);
+    const namesLength = view.getUint16(6, true);
+    const numPoints = view.getUint32(20, true);
+    const names = fieldNames(buffer, FRAME_HEADER_SIZE, numFields, namesLength);
+
+    // arrays are 4 byte aligned, so they can be viewed without copying
+    let offset = FRAME_HEADER_SIZE + ((namesLength + 3) & ~3);
+    const fields = {};
+    for (const name of names) {
+        fields[name] = new Float32Array(buffer, offset, numPoints);
+        offset += 4 * numPoints;
+    }
+
+    return {
+        seq: view.getUint32(8, true),
+        timestampSec: view.getUint32(12, true),
+        timestampNsec: view.getUint32(16, true),
+        numPoints,
+        fields,
+    };
+}
+
+// Decode a delta frame against the fields of its keyframe, into new arrays.
+export function decodeDeltaFrame(buffer, keyframe) {
+    const view = new DataView(buffer);
+    if (frameMagic(buffer) !== DELTA_MAGIC || view.getUint8(4) !== DELTA_VERSION) {
+        throw new Error('Unsupported delta frame');
+    }
+    const numFields = view.getUint8(5);
+    const namesLength = view.getUint16(6, true);
+    const numPoints = view.getUint32(20, true);
+    const quantum = view.getFloat32(28, true);
+    const names = fieldNames(buffer, DELTA_HEADER_SIZE, numFields, namesLength);
+
+    const offsetsStart = DELTA_HEADER_SIZE + ((namesLength + 3) & ~3);
+    let offset = offsetsStart + 8 * numFields;
+    const fields = {};
+    names.forEach((name, k) => {
+        const shift = view.getFloat64(offsetsStart + 8 * k, true);
+        const deltas = new Int16Array(buffer, offset, numPoints);
+        const key = keyframe.fields[name];
+        const values = new Float32Array(numPoints);
+        for (let j = 0; j < numPoints; j++) {
+            values[j] = deltas[j] === DELTA_MISSING ? NaN : key[j] + shift + deltas[j] * quantum;
+        }
+        fields[name] = values;
+        offset += 2 * numPoints;
+    });
+
+    return {
+        seq: view.getUint32(8, true),
+        timestampSec: view.getUint32(12, true),
+        timestampNsec: view.getUint32(16, true),
+        numPoints,
+        fields,
+    };
+}
+
+// Decodes the frames of one format=delta stream, keeping the last keyframe.
+// Returns null for delta frames whose keyframe was not received (yet).
+export class ScanFrameDecoder {
+    keyframe = null;
+
+    decode(buffer) {
+        if (frameMagic(buffer) === FRAME_MAGIC) {
+            this.keyframe = decodeScanFrame(buffer);
+            return this.keyframe;
+        }
+        const keySeq = new DataView(buffer).getUint32(24, true);
+        if (this.keyframe === null || this.keyframe.seq !== keySeq) {
+            return null;
+        }
+        return decodeDeltaFrame(buffer, this.keyframe);
+    }
+}
+
+// A small JSON friendly summary of a frame for display.
+export function summarizeScanFrame(frame) {
+    const fields = {};
+    for (const [name, values] of Object.entries(frame.fields)) {
+        let min = Infinity;
+        let max = -Infinity;
+        for (const value of values) {
+            min = Math.min(min, value);
+            max = Math.max(max, value);
+        }
+        fields[name] = { min, max };
+    }
+    return {
+        seq: frame.seq,
+        timestamp: frame.timestampSec + frame.timestampNsec * 1e-9,
+        numPoints: frame.numPoints,
+        fields,
+    };
+}
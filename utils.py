@@ -1,15 +1,15 @@
-import datetime
-import lidar_pb2
-
-APP_DIRECTORY = "/mnt/managed_home/farm-ng-user-gsainsbury/amiga-fastapi"
+import ctypes
 
-from sick_scan_api import *
+import lidar_pb2
 
-sick_scan_library = SickScanApiLoadLibrary(
-    [os.path.join(APP_DIRECTORY, "sick_scan_ws/build/")],
-    "libsick_scan_xd_shared_lib.so",
+# the decoding functions used to live here, keep them importable from utils
+from pointcloud import (  # noqa: F401
+    POINTFIELD_DATATYPES,
+    pointcloud_dtype,
+    pointcloud_msg_to_points,
+    pySickScanCartesianPointCloudMsgToXYZ,
+    scan_time_offset_ns,
 )
-api_handle = SickScanApiCreate(sick_scan_library)
 
 
 def to_proto(message_contents):
@@ -66,6 +66,14 @@ def to_proto(message_contents):
 
 
 def from_proto(protocol_message):
+    # the ctypes message types come with the driver, only import them when needed
+    from sick_scan_api import (
+        SickScanHeader,
+        SickScanPointCloudMsg,
+        SickScanPointFieldArray,
+        SickScanPointFieldMsg,
+        SickScanUint8Array,
+    )
 
     header = SickScanHeader(
         seq=protocol_message.header.seq,
@@ -122,87 +130,6 @@ def from_proto(protocol_message):
     return message_contents
 
 
-def pySickScanCartesianPointCloudMsgToXYZ(pointcloud_msg, start_time=None):
-    # get pointcloud fields
-    num_fields = pointcloud_msg.fields.size
-    msg_fields_buffer = pointcloud_msg.fields.buffer
-    field_offset_x = -1
-    field_offset_y = -1
-    field_offset_z = -1
-
-    if start_time is not None:
-        scan_time = datetime.datetime.fromtimestamp(
-            pointcloud_msg.header.timestamp_sec
-        ) + datetime.timedelta(
-            microseconds=pointcloud_msg.header.timestamp_nsec // 1000
-        )
-        delta = start_time - scan_time
-        total_nanoseconds = delta.total_seconds() * 1e9 + delta.microseconds * 1000
-
-    for n in range(num_fields):
-        field_name = ctypesCharArrayToString(msg_fields_buffer[n].name)
-        field_offset = msg_fields_buffer[n].offset
-        if field_name == "x":
-            field_offset_x = msg_fields_buffer[n].offset
-        elif field_name == "y":
-            field_offset_y = msg_fields_buffer[n].offset
-        elif field_name == "z":
-            field_offset_z = msg_fields_buffer[n].offset
-    # Extract x,y,z
-    cloud_data_buffer_len = (
-        pointcloud_msg.row_step * pointcloud_msg.height
-    )  # length of polar cloud data in byte
-    assert (
-        pointcloud_msg.data.size == cloud_data_buffer_len
-        and field_offset_x >= 0
-        and field_offset_y >= 0
-        and field_offset_z >= 0
-    )
-    cloud_data_buffer = bytearray(cloud_data_buffer_len)
-    for n in range(cloud_data_buffer_len):
-        cloud_data_buffer[n] = pointcloud_msg.data.buffer[n]
-    points_x = np.zeros(pointcloud_msg.width * pointcloud_msg.height, dtype=np.float32)
-    points_y = np.zeros(pointcloud_msg.width * pointcloud_msg.height, dtype=np.float32)
-    points_z = np.zeros(pointcloud_msg.width * pointcloud_msg.height, dtype=np.float32)
-    point_idx = 0
-    for row_idx in range(pointcloud_msg.height):
-        for col_idx in range(pointcloud_msg.width):
-            # Get lidar point in polar coordinates (range, azimuth and elevation)
-            pointcloud_offset = (
-                row_idx * pointcloud_msg.row_step + col_idx * pointcloud_msg.point_step
-            )
-            points_x[point_idx] = np.frombuffer(
-                cloud_data_buffer,
-                dtype=np.float32,
-                count=1,
-                offset=pointcloud_offset + field_offset_x,
-            )[0]
-            points_y[point_idx] = np.frombuffer(
-                cloud_data_buffer,
-                dtype=np.float32,
-                count=1,
-                offset=pointcloud_offset + field_offset_y,
-            )[0]
-            if start_time is None:
-                points_z[point_idx] = np.frombuffer(
-                    cloud_data_buffer,
-                    dtype=np.float32,
-                    count=1,
-                    offset=pointcloud_offset + field_offset_z,
-                )[0]
-            else:
-                # print(
-                #     "here",
-                #     pointcloud_msg.header.seq,
-                #     pointcloud_msg.header.timestamp_sec,
-                #     pointcloud_msg.header.timestamp_nsec,
-                # )
-
-                points_z[point_idx] = total_nanoseconds
-            point_idx = point_idx + 1
-    return points_x, points_y, points_z
-
-
 # async def create_ply_file_from_buffer(lidar_buffer, start_time):
 #
 #     # xyz = np.random.rand(100, 3)